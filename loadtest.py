@@ -0,0 +1,523 @@
+# -*- coding: utf-8 -*-
+"""
+Load-test harness for the bot handlers in main.py.
+
+Drives synthetic users through /start -> /post -> select -> language -> links -> preview -> post
+against a fake pyrogram client, an in-memory Mongo stand-in and a local TMDB/shortener stub server.
+Nothing leaves the machine. Reports throughput, p50/p99 latency per state transition and memory growth.
+
+    python loadtest.py --users 50 --rounds 3 --tmdb-latency 0.15
+"""
+
+# ---- Core Python Imports ----
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import tempfile
+import tracemalloc
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+OWNER_ID = 1
+CHANNEL_ID = "-1001234567890"
+
+# ---- 1. TMDB / SHORTENER STUB SERVER ----
+
+def make_stub_handler(tmdb_latency: float, image_latency: float, shortener_latency: float, poster_bytes: bytes):
+    poster_etag = '"stub-poster-v1"'
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args): pass
+
+        def _send_json(self, payload: dict):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [p for p in url.path.split("/") if p]
+            query = parse_qs(url.query)
+
+            if parts[:2] == ["t", "p"]:
+                time.sleep(image_latency)
+                if self.headers.get("If-None-Match") == poster_etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(poster_bytes)))
+                self.send_header("ETag", poster_etag)
+                self.end_headers()
+                self.wfile.write(poster_bytes)
+                return
+
+            if parts == ["api"]:
+                time.sleep(shortener_latency)
+                return self._send_json({"status": "success", "shortenedUrl": f"https://sho.rt/{random.randrange(16 ** 6):06x}"})
+
+            time.sleep(tmdb_latency)
+            if parts[:3] == ["3", "search", "multi"]:
+                name = query.get("query", ["Movie"])[0]
+                return self._send_json({"results": [
+                    {"id": 1000 + i, "media_type": "movie", "title": f"{name} {i}", "release_date": "2024-05-01"} for i in range(5)
+                ]})
+            if parts[:2] == ["3", "trending"] or parts[-1:] == ["popular"]:
+                media_type = "movie" if parts[1] in ("trending", "movie") else "tv"
+                return self._send_json({"results": [{"id": 1000 + i, "media_type": media_type, "title": f"Hot {i}"} for i in range(5)]})
+            if parts[:2] == ["3", "find"]:
+                return self._send_json({"movie_results": [{"id": 1000, "title": "Found Movie", "release_date": "2023-01-01"}], "tv_results": []})
+            if len(parts) == 3 and parts[0] == "3" and parts[1] in ("movie", "tv"):
+                media_id = int(parts[2])
+                return self._send_json({
+                    "id": media_id, "title": f"Movie {media_id}", "name": f"Show {media_id}",
+                    "release_date": "2024-05-01", "first_air_date": "2024-05-01",
+                    "vote_average": 7.4, "runtime": 128, "episode_run_time": [45],
+                    "genres": [{"name": "Action"}, {"name": "Drama"}],
+                    "poster_path": f"/poster_{media_id}.jpg", "backdrop_path": f"/backdrop_{media_id}.jpg",
+                    "images": {"backdrops": [{"file_path": f"/backdrop_{media_id}_{i}.jpg", "vote_average": 5 - i} for i in range(4)]},
+                    "credits": {"cast": [], "crew": []},
+                })
+            self.send_response(404)
+            self.end_headers()
+
+    return StubHandler
+
+def start_stub_server(args, poster_bytes: bytes):
+    handler = make_stub_handler(args.tmdb_latency, args.image_latency, args.shortener_latency, poster_bytes)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_stub_poster(width: int = 500, height: int = 750):
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (width, height), (30, 40, 60))
+    draw = ImageDraw.Draw(img)
+    rng = random.Random(7)
+    for _ in range(60):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.ellipse((x, y, x + rng.randrange(20, 120), y + rng.randrange(20, 120)), fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+# ---- 2. IN-MEMORY MONGO STAND-IN ----
+
+class _Result:
+    def __init__(self, **fields): self.__dict__.update(fields)
+
+def _matches(doc: dict, flt: dict):
+    for key, cond in flt.items():
+        value = doc.get(key)
+        if isinstance(cond, dict) and any(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$in" and value not in arg: return False
+                if op == "$nin" and value in arg: return False
+                if op == "$lte" and not (value is not None and value <= arg): return False
+                if op == "$gte" and not (value is not None and value >= arg): return False
+                if op == "$ne" and value == arg: return False
+        elif value != cond:
+            return False
+    return True
+
+def _apply_update(doc: dict, update: dict, inserting: bool):
+    for field, value in update.get("$set", {}).items(): doc[field] = value
+    if inserting:
+        for field, value in update.get("$setOnInsert", {}).items(): doc[field] = value
+    for field in update.get("$unset", {}): doc.pop(field, None)
+    for field, value in update.get("$addToSet", {}).items():
+        items = doc.setdefault(field, [])
+        if value not in items: items.append(value)
+    for field, value in update.get("$pull", {}).items():
+        doc[field] = [item for item in doc.get(field, []) if item != value]
+
+class FakeCursor:
+    def __init__(self, docs: list):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda d: d.get(key), reverse=direction < 0)
+        return self
+
+    def limit(self, n: int):
+        self._docs = self._docs[:n]
+        return self
+
+    async def to_list(self, length=None):
+        return [dict(d) for d in (self._docs if length is None else self._docs[:length])]
+
+    def __aiter__(self):
+        self._iter = iter(self._docs)
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0)
+        try: return dict(next(self._iter))
+        except StopIteration: raise StopAsyncIteration
+
+class FakeCollection:
+    """Just enough of motor's AsyncIOMotorCollection for main.py, with an optional per-call delay."""
+    def __init__(self, latency: float = 0.0):
+        self.docs = {}
+        self.latency = latency
+        self.calls = {}
+        self._ids = itertools.count(1)
+
+    async def _io(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+
+    async def find_one(self, flt: dict):
+        await self._io("find_one")
+        doc = next((d for d in self.docs.values() if _matches(d, flt)), None)
+        return dict(doc) if doc else None
+
+    def find(self, flt: dict = None):
+        self.calls["find"] = self.calls.get("find", 0) + 1
+        return FakeCursor([d for d in self.docs.values() if _matches(d, flt or {})])
+
+    async def count_documents(self, flt: dict):
+        await self._io("count_documents")
+        return sum(1 for d in self.docs.values() if _matches(d, flt))
+
+    async def insert_one(self, doc: dict):
+        await self._io("insert_one")
+        doc = dict(doc)
+        doc.setdefault("_id", next(self._ids))
+        self.docs[doc["_id"]] = doc
+        return _Result(inserted_id=doc["_id"])
+
+    def _update(self, flt: dict, update: dict, upsert: bool, many: bool):
+        matched = [d for d in self.docs.values() if _matches(d, flt)]
+        if not many: matched = matched[:1]
+        for doc in matched: _apply_update(doc, update, inserting=False)
+        if matched or not upsert: return _Result(matched_count=len(matched), modified_count=len(matched), upserted_id=None)
+        doc = {k: v for k, v in flt.items() if not isinstance(v, dict)}
+        doc.setdefault("_id", next(self._ids))
+        _apply_update(doc, update, inserting=True)
+        self.docs[doc["_id"]] = doc
+        return _Result(matched_count=0, modified_count=0, upserted_id=doc["_id"])
+
+    async def update_one(self, flt: dict, update: dict, upsert: bool = False):
+        await self._io("update_one")
+        return self._update(flt, update, upsert, many=False)
+
+    async def update_many(self, flt: dict, update: dict, upsert: bool = False):
+        await self._io("update_many")
+        return self._update(flt, update, upsert, many=True)
+
+    async def find_one_and_update(self, flt: dict, update: dict, return_document=False, **kwargs):
+        await self._io("find_one_and_update")
+        doc = next((d for d in self.docs.values() if _matches(d, flt)), None)
+        if doc is None: return None
+        before = dict(doc)
+        _apply_update(doc, update, inserting=False)
+        return dict(doc) if return_document else before
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        # pymongo's UpdateOne keeps its arguments in private attributes; one round trip for the whole batch
+        await self._io("bulk_write")
+        for op in operations: self._update(op._filter, op._doc, op._upsert, many=False)
+        return _Result(matched_count=len(operations))
+
+    async def delete_one(self, flt: dict):
+        await self._io("delete_one")
+        doc = next((d for d in self.docs.values() if _matches(d, flt)), None)
+        if doc: del self.docs[doc["_id"]]
+        return _Result(deleted_count=1 if doc else 0)
+
+    async def create_index(self, *args, **kwargs):
+        return "stub_index"
+
+# ---- 3. FAKE PYROGRAM CLIENT ----
+
+class FakeUser:
+    def __init__(self, uid: int, first_name: str):
+        self.id, self.first_name = uid, first_name
+
+class FakeChat:
+    def __init__(self, chat_id, title: str = None):
+        self.id, self.title = chat_id, title or f"Channel {chat_id}"
+
+class FakePhoto:
+    def __init__(self, file_id: str):
+        self.file_id = file_id
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, client, chat_id, from_user=None, text=None, photo=None, reply_markup=None):
+        self.id = next(self._ids)
+        self._client = client
+        self.chat = FakeChat(chat_id)
+        self.from_user = from_user
+        self.text = text
+        self.photo = photo
+        self.reply_markup = reply_markup
+        self.command = text[1:].split() if text and text.startswith("/") else None
+
+    async def reply_text(self, text, **kwargs):
+        return await self._client.send_message(self.chat.id, text, **kwargs)
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        await self._client._api("edit_message_text")
+        self.text, self.reply_markup = text, reply_markup
+        return self
+
+    async def delete(self):
+        await self._client._api("delete_messages")
+
+    async def copy(self, chat_id, **kwargs):
+        return await self._client.send_message(chat_id, self.text)
+
+class FakeCallbackQuery:
+    def __init__(self, client, user: FakeUser, data: str, message: FakeMessage):
+        self._client, self.from_user, self.data, self.message = client, user, data, message
+
+    async def answer(self, *args, **kwargs):
+        await self._client._api("answer_callback_query")
+
+class FakeClient:
+    """Records every Bot API call and sleeps `latency` seconds per call, like a round trip to Telegram would."""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self.sent = {}  # chat_id -> last message sent there
+        self._file_ids = itertools.count(1)
+
+    async def _api(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+
+    def _read_upload(self, photo):
+        # Touch the bytes the way a real upload would, so spooled files and buffers are actually read
+        if isinstance(photo, str):
+            if os.path.exists(photo):
+                with open(photo, "rb") as f: f.read()
+            return
+        if hasattr(photo, "read"):
+            photo.seek(0)
+            photo.read()
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self._api("send_message")
+        msg = FakeMessage(self, chat_id, text=text, reply_markup=reply_markup)
+        self.sent[chat_id] = msg
+        return msg
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        await self._api("send_photo")
+        self._read_upload(photo)
+        msg = FakeMessage(self, chat_id, text=caption, photo=FakePhoto(f"photo-{next(self._file_ids)}"))
+        self.sent[chat_id] = msg
+        return msg
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self._api("send_media_group")
+        messages = []
+        for item in media:
+            self._read_upload(item.media)
+            messages.append(FakeMessage(self, chat_id, text=item.caption, photo=FakePhoto(f"photo-{next(self._file_ids)}")))
+        self.sent[chat_id] = messages[-1]
+        return messages
+
+    async def get_chat(self, chat_id):
+        await self._api("get_chat")
+        return FakeChat(chat_id)
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._api("get_chat_member")
+        return True
+
+    async def download_media(self, message, file_name=None, in_memory=False, **kwargs):
+        await self._api("download_media")
+        return file_name
+
+# ---- 4. SYNTHETIC USERS ----
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, step: str, seconds: float):
+        self.latencies.setdefault(step, []).append(seconds)
+
+    def fail(self, step: str, error: Exception):
+        key = f"{step}: {type(error).__name__}: {error}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+def percentile(values: list, pct: float):
+    if not values: return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def find_button(markup, prefix: str):
+    for row in (markup.inline_keyboard if markup else []):
+        for button in row:
+            if (button.callback_data or "").startswith(prefix): return button.callback_data
+    return None
+
+async def run_step(main, recorder: Recorder, step: str, handler, *args):
+    started = time.perf_counter()
+    try:
+        await handler(*args)
+        # Handlers only enqueue onto the user's dispatch queue; the step is done when the queue has drained
+        await main.user_dispatcher.join(args[1].from_user.id)
+    except Exception as e:
+        recorder.fail(step, e)
+        return False
+    recorder.add(step, time.perf_counter() - started)
+    return True
+
+async def user_flow(main, client: FakeClient, user: FakeUser, recorder: Recorder, rounds: int, think_time: float):
+    def msg(text):
+        return FakeMessage(client, user.id, from_user=user, text=text)
+
+    async def think():
+        if think_time: await asyncio.sleep(random.uniform(0, think_time))
+
+    completed = 0
+    for round_no in range(rounds):
+        if not await run_step(main, recorder, "start_cmd", main.start_cmd, client, msg("/start")): continue
+        await think()
+        if not await run_step(main, recorder, "search_commands", main.search_commands, client, msg(f"/post Stub Movie {round_no % 7} 2024")): continue
+        select_data = find_button(client.sent.get(user.id) and client.sent[user.id].reply_markup, "select_")
+        if not select_data:
+            recorder.fail("search_commands", RuntimeError("no select_ button in results"))
+            continue
+        await think()
+        # Spread users over a handful of titles so coalescing and caches see realistic overlap
+        select_data = f"{select_data.rsplit('_', 1)[0]}_{1000 + (user.id + round_no) % 5}"
+        cb_msg = FakeMessage(client, user.id, from_user=user)
+        if not await run_step(main, recorder, "selection_cb", main.selection_cb, client, FakeCallbackQuery(client, user, select_data, cb_msg)): continue
+
+        ok = True
+        for state, text in (("wait_movie_lang", "English"), ("wait_480p", "https://files.example/480"),
+                            ("wait_720p", "https://files.example/720"), ("wait_1080p", "https://files.example/1080")):
+            await think()
+            if not await run_step(main, recorder, f"conversation_handler:{state}", main.conversation_handler, client, msg(text)):
+                ok = False
+                break
+        if not ok: continue
+
+        convo = main.user_conversations.get(user.id) or {}
+        if "final_post" not in convo:
+            recorder.fail("conversation_handler:wait_1080p", RuntimeError("no final_post after preview"))
+            continue
+        await think()
+        if await run_step(main, recorder, "post_to_channel_cb", main.post_to_channel_cb, client,
+                          FakeCallbackQuery(client, user, f"postto_{CHANNEL_ID}", FakeMessage(client, user.id, from_user=user))):
+            completed += 1
+    return completed
+
+# ---- 5. DRIVER ----
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def load_bot_module(args, stub_url: str, work_dir: str):
+    # main.py reads its configuration at import time, so everything must be in the environment first
+    os.environ.update({
+        "BOT_TOKEN": "0:loadtest", "API_ID": "1", "API_HASH": "loadtest", "TMDB_API_KEY": "loadtest",
+        "FORCE_SUB_CHANNEL": "", "INVITE_LINK": "", "OWNER_ID": str(OWNER_ID),
+        "DATABASE_URI": "mongodb://127.0.0.1:1", "PORT": "0",
+        "TMDB_API_BASE": f"{stub_url}/3", "TMDB_IMAGE_BASE": f"{stub_url}/t/p",
+        "POSTER_CACHE_DIR": os.path.join(work_dir, "poster_cache"),
+        "POSTER_SPOOL_DIR": os.path.join(work_dir, "poster_spool"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    main.users_collection = FakeCollection(args.db_latency)
+    main.scheduled_collection = FakeCollection(args.db_latency)
+    if args.skip_face_detection: main.get_face_cascade = lambda: None
+    return main
+
+async def seed_users(main, users: list, stub_url: str, album: int):
+    for user in users:
+        await main.users_collection.update_one({'_id': user.id}, {'$set': {
+            'first_name': user.first_name, 'is_premium': True, 'channel_ids': [CHANNEL_ID],
+            'watermark_text': "@LoadTestChannel", 'shortener_api': "stub-key", 'shortener_url': stub_url,
+            'album_backdrops': album,
+        }}, upsert=True)
+    main.users_collection.calls.clear()
+
+async def run(args):
+    work_dir = tempfile.mkdtemp(prefix="bot_loadtest_")
+    server = start_stub_server(args, make_stub_poster())
+    stub_url = f"http://127.0.0.1:{server.server_address[1]}"
+    main = load_bot_module(args, stub_url, work_dir)
+
+    users = [FakeUser(10_000 + i, f"User{i}") for i in range(args.users)]
+    await seed_users(main, users, stub_url, args.album)
+    client = FakeClient(args.telegram_latency)
+    recorder = Recorder()
+    if args.prefetch:
+        warm_started = time.perf_counter()
+        warmed = await main.prefetch_trending(max_titles=20, time_budget=120)
+        print(f"🔥 Prefetched {warmed} trending titles in {time.perf_counter() - warm_started:.2f}s before the run")
+
+    tracemalloc.start()
+    rss_before = rss_bytes()
+    started = time.perf_counter()
+    completed = await asyncio.gather(*(user_flow(main, client, user, recorder, args.rounds, args.think_time) for user in users))
+    elapsed = time.perf_counter() - started
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = rss_bytes()
+    server.shutdown()
+
+    total = sum(completed)
+    print(f"\n🚀 {args.users} users x {args.rounds} rounds: {total} posts completed in {elapsed:.2f}s "
+          f"→ {total / elapsed:.2f} posts/s, {sum(len(v) for v in recorder.latencies.values()) / elapsed:.1f} handler calls/s\n")
+    print(f"{'state transition':<36}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, values in recorder.latencies.items():
+        print(f"{step:<36}{len(values):>7}{percentile(values, 50) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}{max(values) * 1000:>10.1f}")
+
+    print(f"\n🧠 RSS: {rss_before / 2**20:.1f} MB → {rss_after / 2**20:.1f} MB (+{(rss_after - rss_before) / 2**20:.1f} MB), "
+          f"python heap peak {traced_peak / 2**20:.1f} MB, render budget peak {main.render_memory.peak / 2**20:.1f} MB, "
+          f"{len(main.user_conversations)} sessions left open")
+    print(f"📡 Telegram calls: {sum(client.calls.values())}  {dict(sorted(client.calls.items()))}")
+    print(f"🗄️  Mongo calls: {sum(main.users_collection.calls.values())}  {dict(sorted(main.users_collection.calls.items()))}, "
+          f"user writes skipped as no-ops: {main.user_writes.skipped}, still buffered: {len(main.user_writes.pending)}")
+    print(f"\n⏱️  Handler wall/CPU breakdown (from main.track_handler):\n{main.format_handler_stats()}")
+    if main.user_dispatcher.errors:
+        recorder.errors["handler exceptions (see log above)"] = main.user_dispatcher.errors
+    if recorder.errors:
+        print("\n❌ Errors:")
+        for error, count in sorted(recorder.errors.items(), key=lambda e: -e[1]): print(f"  {count:>5} × {error}")
+    return 0 if not recorder.errors else 1
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the bot handlers with synthetic users and local stubs.")
+    parser.add_argument("--users", type=int, default=20, help="concurrent synthetic users")
+    parser.add_argument("--rounds", type=int, default=2, help="full post flows per user")
+    parser.add_argument("--think-time", type=float, default=0.0, help="max random pause between a user's steps (s)")
+    parser.add_argument("--tmdb-latency", type=float, default=0.1, help="stub TMDB API latency (s)")
+    parser.add_argument("--image-latency", type=float, default=0.1, help="stub TMDB image CDN latency (s)")
+    parser.add_argument("--shortener-latency", type=float, default=0.1, help="stub URL shortener latency (s)")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="fake Bot API latency per call (s)")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="fake Mongo latency per call (s)")
+    parser.add_argument("--album", type=int, default=0, help="backdrops per post (album mode), 0 = single poster")
+    parser.add_argument("--prefetch", action="store_true", help="run one trending prefetch round before the load starts")
+    parser.add_argument("--skip-face-detection", action="store_true", help="don't load the Haar cascade (no network needed)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
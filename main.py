@@ -4,19 +4,38 @@
 import os
 import io
 import re
+import sys
+import types
+import pstats
+import cProfile
+import json
+import time
+import copy
+import heapq
+import hashlib
+import tempfile
+import contextlib
+import functools
+import itertools
 import requests
 import asyncio
-from threading import Thread
+from datetime import datetime, timedelta, timezone
+from threading import Thread, Lock, local as thread_local, get_ident as threading_ident, enumerate as threading_enumerate
 import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # --- Third-party Library Imports ---
 from PIL import Image, ImageDraw, ImageFont
-from pyrogram import Client, filters, enums
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
+from pyrogram import Client, filters, enums, idle
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery, InputMediaPhoto
 from pyrogram.errors import UserNotParticipant, FloodWait
 from flask import Flask
 from dotenv import load_dotenv
 import motor.motor_asyncio
+from bson import ObjectId
+from pymongo import UpdateOne, ReturnDocument
 import numpy as np
 import cv2  # OpenCV for Face Detection
 
@@ -43,10 +62,73 @@ if not DB_URI:
 db_client = motor.motor_asyncio.AsyncIOMotorClient(DB_URI)
 db = db_client[DB_NAME]
 users_collection = db.users
+scheduled_collection = db.scheduled_posts
+USER_FLUSH_SIZE = int(os.getenv("USER_FLUSH_SIZE", "100"))  # pending users that trigger an immediate flush
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "2"))  # seconds between background flushes
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))  # users whose stored fields we remember for no-op checks
+
+# ---- ⏰ Scheduled Posting Setup ----
+SCHEDULE_POLL_INTERVAL = int(os.getenv("SCHEDULE_POLL_INTERVAL", "15"))  # seconds between queue checks
+SCHEDULE_BATCH_SIZE = int(os.getenv("SCHEDULE_BATCH_SIZE", "50"))
+SCHEDULE_CONCURRENCY = int(os.getenv("SCHEDULE_CONCURRENCY", "5"))  # chats posted to at the same time
+SCHEDULE_CHAT_INTERVAL = float(os.getenv("SCHEDULE_CHAT_INTERVAL", "3"))  # min seconds between posts in one chat
+SCHEDULE_MAX_ATTEMPTS = int(os.getenv("SCHEDULE_MAX_ATTEMPTS", "5"))
+SCHEDULE_TZ = timezone(timedelta(hours=float(os.getenv("SCHEDULE_TZ_OFFSET", "0"))))  # timezone users type times in
+
+# ---- 🎬 TMDB Client Setup ----
+TMDB_API_BASE = os.getenv("TMDB_API_BASE", "https://api.themoviedb.org/3")
+TMDB_RATE_LIMIT = float(os.getenv("TMDB_RATE_LIMIT", "35"))  # sustained requests/second (TMDB allows ~50)
+TMDB_RATE_BURST = int(os.getenv("TMDB_RATE_BURST", "20"))
+PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, PRIORITY_BULK = 0, 1, 2  # lower value is served first
+DETAILS_CACHE_TTL = int(os.getenv("DETAILS_CACHE_TTL", str(6 * 3600)))
+DETAILS_CACHE_SIZE = int(os.getenv("DETAILS_CACHE_SIZE", "500"))
+
+# ---- 🔥 Trending Prefetch Setup ----
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", "1800"))  # seconds between prefetch rounds
+PREFETCH_MAX_TITLES = int(os.getenv("PREFETCH_MAX_TITLES", "30"))  # per round, 0 disables the prefetcher
+PREFETCH_TIME_BUDGET = int(os.getenv("PREFETCH_TIME_BUDGET", "300"))  # seconds a round may take, idle waits included
+PREFETCH_LISTS = ["/trending/all/day", "/movie/popular", "/tv/popular"]
+
+# ---- 🖼️ Poster Cache Setup ----
+TMDB_IMAGE_BASE = os.getenv("TMDB_IMAGE_BASE", "https://image.tmdb.org/t/p")
+POSTER_CACHE_DIR = os.getenv("POSTER_CACHE_DIR", "poster_cache")
+POSTER_CACHE_MAX_MB = int(os.getenv("POSTER_CACHE_MAX_MB", "200"))
+POSTER_CACHE_TTL = int(os.getenv("POSTER_CACHE_TTL", "86400"))  # seconds before a cached poster is revalidated
+POSTER_TARGET_WIDTH = int(os.getenv("POSTER_TARGET_WIDTH", "500"))  # output width the posters are rendered for
+TMDB_POSTER_SIZES = [(92, "w92"), (154, "w154"), (185, "w185"), (342, "w342"), (500, "w500"), (780, "w780")]
+TMDB_BACKDROP_SIZES = [(300, "w300"), (780, "w780"), (1280, "w1280")]
+BACKDROP_TARGET_WIDTH = int(os.getenv("BACKDROP_TARGET_WIDTH", "780"))
+MAX_ALBUM_BACKDROPS = 9  # Telegram media groups hold at most 10 items, the poster takes one
+os.makedirs(POSTER_CACHE_DIR, exist_ok=True)
+BADGE_DETECT_WIDTH = int(os.getenv("BADGE_DETECT_WIDTH", "320"))  # face detection runs on a copy this wide
+
+# Shared HTTP session so every outbound call reuses pooled keep-alive connections
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=32))
+http_session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=32))
+
+# ---- 🧠 Poster Memory Setup ----
+POSTER_SPOOL_DIR = os.getenv("POSTER_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "poster_spool"))
+POSTER_SPOOL_THRESHOLD = int(os.getenv("POSTER_SPOOL_THRESHOLD", str(256 * 1024)))  # bigger blobs live on disk
+POSTER_SPOOL_MAX_AGE = int(os.getenv("POSTER_SPOOL_MAX_AGE", str(6 * 3600)))  # abandoned sessions' files are swept after this
+RENDER_MEMORY_BUDGET_MB = int(os.getenv("RENDER_MEMORY_BUDGET_MB", "256"))
+RENDER_QUEUE_TIMEOUT = int(os.getenv("RENDER_QUEUE_TIMEOUT", "30"))  # seconds a render may wait for memory
+os.makedirs(POSTER_SPOOL_DIR, exist_ok=True)
+
+# ---- 🩺 Profiling Setup ----
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))  # seconds between stack samples
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+
+# ---- 🚦 Update Dispatch Setup ----
+USER_CONCURRENCY = int(os.getenv("USER_CONCURRENCY", "64"))  # users whose updates may run at the same time
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "20"))  # seconds queued updates get to finish on shutdown
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))  # pyrogram's handler slots
 
 # ---- Global Variables & Bot Initialization ----
 user_conversations = {}
-bot = Client("UltimateMovieBot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+bot = Client("UltimateMovieBot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, workers=BOT_WORKERS)
 
 # ---- Flask App (for Keep-Alive) ----
 app = Flask(__name__)
@@ -74,25 +156,216 @@ def download_cascade():
 
 # --- DATABASE & PREMIUM HELPERS ---
 
+class UserWriteBuffer:
+    """Write-behind buffer for user $set/$unset/$setOnInsert updates.
+
+    Writes that match what we know is stored are dropped, pending writes are merged per user and
+    flushed as one ordered bulk_write when USER_FLUSH_SIZE users are pending or every USER_FLUSH_INTERVAL.
+    """
+    def __init__(self):
+        self.known = OrderedDict()  # uid -> (fields as stored after pending writes land, whether that started from a DB read)
+        self.pending = {}  # uid -> {'$set': {...}, '$unset': {...}, '$setOnInsert': {...}}
+        self.in_flight = {}  # batch currently inside bulk_write, same shape as pending
+        self.versions = {}  # uid -> count of buffered writes, so stale reads can be told apart
+        self.skipped = self.flushed = 0
+        self._lock = self._stopping = None
+
+    @staticmethod
+    def _merge_ops(older: dict, newer: dict):
+        merged = {op: dict(fields) for op, fields in older.items()}
+        for field, value in newer.get('$set', {}).items():
+            merged.setdefault('$set', {})[field] = value
+            merged.get('$unset', {}).pop(field, None)
+        for field in newer.get('$unset', {}):
+            merged.setdefault('$unset', {})[field] = ""
+            merged.get('$set', {}).pop(field, None)
+        for field, value in newer.get('$setOnInsert', {}).items():
+            merged.setdefault('$setOnInsert', {}).setdefault(field, value)
+        return merged
+
+    def remember_read(self, uid: int, doc: dict, version: int):
+        """Caches a DB read for no-op checks, unless writes for the user were buffered or in flight around it."""
+        if uid in self.pending or uid in self.in_flight or self.versions.get(uid, 0) != version: return
+        self._remember(uid, dict(doc), from_read=True)
+
+    def _remember(self, uid: int, doc: dict, from_read: bool):
+        self.known[uid] = (doc, from_read)
+        self.known.move_to_end(uid)
+        while len(self.known) > USER_CACHE_SIZE: self.known.popitem(last=False)
+
+    async def update(self, uid: int, set: dict = None, unset: list = None, set_on_insert: dict = None):
+        known, from_read = self.known.get(uid, (None, False))
+        changes = {}
+        if set:
+            fields = {k: v for k, v in set.items() if known is None or k not in known or known[k] != v}
+            if fields: changes['$set'] = fields
+        if unset:
+            # A missing field only proves absence if the entry is a full document; our own guesses are partial
+            fields = {k: "" for k in unset if not from_read or k in known}
+            if fields: changes['$unset'] = fields
+        if set_on_insert and known is None:
+            changes['$setOnInsert'] = dict(set_on_insert)
+        if not changes:
+            self.skipped += 1
+            return
+
+        self.pending[uid] = self._merge_ops(self.pending.get(uid, {}), changes)
+        self.versions[uid] = self.versions.get(uid, 0) + 1
+
+        # Optimistically record the result so the next identical write is a no-op too. Without a prior read
+        # we only know the fields we wrote ($setOnInsert may not apply to an existing user)
+        doc = dict(known or {})
+        doc.update(changes.get('$set', {}))
+        for field in changes.get('$unset', {}): doc.pop(field, None)
+        self._remember(uid, doc, from_read)
+
+        if len(self.pending) >= USER_FLUSH_SIZE: await self.flush()
+
+    def overlay(self, uid: int, user_data: dict):
+        """Applies not-yet-flushed (and still in-flight) writes on top of a document read from the DB."""
+        ops = self._merge_ops(self.in_flight.get(uid, {}), self.pending.get(uid, {}))
+        if not ops: return user_data
+        doc = dict(user_data) if user_data else {'_id': uid, **ops.get('$setOnInsert', {})}
+        doc.update(ops.get('$set', {}))
+        for field in ops.get('$unset', {}): doc.pop(field, None)
+        return doc
+
+    async def flush(self):
+        if self._lock is None: self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.pending: return
+            # The batch stays visible (overlay, no-op checks) in in_flight until bulk_write returns
+            self.in_flight, self.pending = self.pending, {}
+            operations = [UpdateOne({'_id': uid}, {op: fields for op, fields in ops.items() if fields}, upsert=True) for uid, ops in self.in_flight.items()]
+            try:
+                await users_collection.bulk_write(operations, ordered=True)
+                self.flushed += len(operations)
+            except BaseException as e:
+                # Includes cancellation: re-queue so the shutdown flush (or the next one) still writes it
+                logger.error(f"User write flush failed ({len(operations)} users), will retry: {e!r}")
+                for uid, ops in self.in_flight.items():
+                    # Anything queued meanwhile is newer and wins over the failed batch
+                    self.pending[uid] = self._merge_ops(ops, self.pending.get(uid, {}))
+                    self.known.pop(uid, None)
+                if not isinstance(e, Exception): raise
+            finally:
+                self.in_flight = {}
+
+    async def flusher(self):
+        self._stopping = asyncio.Event()
+        while not self._stopping.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stopping.wait(), USER_FLUSH_INTERVAL)
+            try: await self.flush()
+            except Exception as e: logger.error(f"User write flusher error: {e}")
+
+    def stop(self):
+        """Asks the flusher to write what is pending and exit, without cancelling it mid-write."""
+        if self._stopping: self._stopping.set()
+
+user_writes = UserWriteBuffer()
+
+async def get_user_data(user_id: int):
+    version = user_writes.versions.get(user_id, 0)
+    user_data = await users_collection.find_one({'_id': user_id})
+    if user_data: user_writes.remember_read(user_id, user_data, version)
+    return user_writes.overlay(user_id, user_data)
+
 async def add_user_to_db(user):
     # Default is_premium to False unless already set
-    await users_collection.update_one(
-        {'_id': user.id},
-        {
-            '$set': {'first_name': user.first_name},
-            '$setOnInsert': {'is_premium': False} 
-        },
-        upsert=True
-    )
+    await user_writes.update(user.id, set={'first_name': user.first_name}, set_on_insert={'is_premium': False})
 
 async def is_user_premium(user_id: int) -> bool:
     if user_id == OWNER_ID: return True # Owner is always premium
-    user_data = await users_collection.find_one({'_id': user_id})
+    user_data = await get_user_data(user_id)
     return user_data.get('is_premium', False) if user_data else False
 
+# --- BACKGROUND JOBS ---
+
+background_jobs = set()  # strong refs to fire-and-forget tasks; cancelled on shutdown
+
+def _background_done(task: asyncio.Task):
+    background_jobs.discard(task)
+    if task.cancelled(): logger.warning(f"Background job {task.get_name()} cancelled")
+    elif task.exception(): logger.error(f"Background job {task.get_name()} failed", exc_info=task.exception())
+    else: logger.info(f"Background job {task.get_name()} finished: {task.result()}")
+
+def spawn_background(coro, name: str):
+    """Runs `coro` detached from the caller, but keeps a reference and logs how it ended."""
+    task = asyncio.ensure_future(coro)
+    task.set_name(name)
+    background_jobs.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
 # --- DECORATORS ---
 
+class UserDispatcher:
+    """Runs one user's updates strictly in arrival order; different users run in parallel, up to `max_concurrency`."""
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.errors = 0
+        self.closed = False
+        self._queues = {}  # uid -> deque of pending (func, client, update)
+        self._workers = {}  # uid -> task draining that user's queue
+        self._slots = None
+
+    def submit(self, uid: int, func, client, update):
+        if self.closed:
+            logger.warning(f"Dropping update for user {uid}: shutting down")
+            return
+        self._queues.setdefault(uid, deque()).append((func, client, update))
+        if uid not in self._workers:
+            self._workers[uid] = asyncio.ensure_future(self._drain(uid))
+
+    async def _drain(self, uid: int):
+        if self._slots is None: self._slots = asyncio.Semaphore(self.max_concurrency)
+        queue = self._queues[uid]
+        try:
+            while queue:
+                func, client, update = queue.popleft()
+                async with self._slots:
+                    try:
+                        await func(client, update)
+                    except Exception as e:
+                        self.errors += 1
+                        logger.exception(f"Handler {getattr(func, '__name__', func)} failed for user {uid}: {e}")
+        finally:
+            # Nothing can be queued between the empty check and here: there is no await in between
+            self._workers.pop(uid, None)
+            if not queue: self._queues.pop(uid, None)
+
+    def backlog(self):
+        return sum(len(q) for q in self._queues.values()), len(self._workers)
+
+    async def shutdown(self, timeout: float):
+        """Stops taking updates, lets queued ones finish and cancels whatever is still running after `timeout`."""
+        self.closed = True
+        workers = list(self._workers.values())
+        if not workers: return
+        _, unfinished = await asyncio.wait(workers, timeout=timeout)
+        for task in unfinished: task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+        if unfinished: logger.warning(f"Cancelled {len(unfinished)} user queues still busy after {timeout}s")
+
+    async def join(self, uid: int):
+        """Waits until everything queued for `uid` so far has run."""
+        while uid in self._workers:
+            await asyncio.wait({self._workers[uid]})
+
+user_dispatcher = UserDispatcher(USER_CONCURRENCY)
+
+def serialize_per_user(func):
+    """Queues the update on its user's queue and frees pyrogram's handler slot right away."""
+    @functools.wraps(func)
+    async def wrapper(client, update):
+        user = getattr(update, "from_user", None)
+        if user is None: return await func(client, update)
+        user_dispatcher.submit(user.id, func, client, update)
+    return wrapper
+
 def force_subscribe(func):
+    @functools.wraps(func)
     async def wrapper(client, message):
         if FORCE_SUB_CHANNEL:
             try:
@@ -109,6 +382,7 @@ def force_subscribe(func):
 
 def check_premium(func):
     """Decorator to restrict commands to Premium Users only"""
+    @functools.wraps(func)
     async def wrapper(client, message):
         user_id = message.from_user.id
         if await is_user_premium(user_id):
@@ -124,17 +398,179 @@ def check_premium(func):
             )
     return wrapper
 
+# --- PROFILING & HANDLER TIMING ---
+
+handler_stats = {}  # "handler[:state]" -> {'count', 'wall', 'cpu', 'max_wall'}
+active_profile = None
+
+def record_timing(key: str, wall: float, cpu: float):
+    stat = handler_stats.setdefault(key, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'max_wall': 0.0})
+    stat['count'] += 1
+    stat['wall'] += wall
+    stat['cpu'] += cpu
+    stat['max_wall'] = max(stat['max_wall'], wall)
+
+@types.coroutine
+def _cpu_timed(coro, cpu: list):
+    """Drives `coro` step by step, adding only the loop-thread CPU time of its own steps to cpu[0]."""
+    value, error = None, None
+    while True:
+        started = time.thread_time()
+        try:
+            yielded = coro.throw(error) if error is not None else coro.send(value)
+        except StopIteration as stop:
+            cpu[0] += time.thread_time() - started
+            return stop.value
+        except BaseException:
+            cpu[0] += time.thread_time() - started
+            raise
+        cpu[0] += time.thread_time() - started
+        value, error = None, None
+        try:
+            value = yield yielded
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            error = e
+
+def track_handler(name: str, state_of=None):
+    """Records wall/CPU time per handler (and per conversation state) and feeds the /profile call counter."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(client, update):
+            key = name
+            if state_of:
+                state = state_of(update)
+                if state: key = f"{name}:{state}"
+            cpu = [0.0]
+            started = time.perf_counter()
+            try:
+                return await _cpu_timed(func(client, update), cpu)
+            finally:
+                record_timing(key, time.perf_counter() - started, cpu[0])
+                if active_profile: active_profile.tick()
+        return wrapper
+    return decorator
+
+def run_profiled(func, *args):
+    """Runs a render-pool job, timing it and profiling it when a /profile session is active."""
+    session = active_profile
+    wall_started, cpu_started = time.perf_counter(), time.thread_time()
+    try:
+        profile = None
+        if session and session.mode == "cprofile":
+            profile = cProfile.Profile()
+            try: profile.enable()
+            except ValueError: profile = None  # 3.12+: one process-wide profiler, the loop's one already sees this thread
+        if profile is None: return func(*args)
+        try: return func(*args)
+        finally:
+            profile.disable()
+            session.thread_profiles.append(profile)
+    finally:
+        record_timing(f"render_pool:{func.__name__}", time.perf_counter() - wall_started, time.thread_time() - cpu_started)
+
+class ProfileSession:
+    """One /profile run: cProfile on the loop thread plus every render job, or stack sampling across all threads."""
+    def __init__(self, client, chat_id: int, mode: str, calls: int = None, seconds: float = None):
+        self.client, self.chat_id, self.mode = client, chat_id, mode
+        self.calls_left, self.seconds = calls, seconds
+        self.loop_profile = None
+        self.thread_profiles = []
+        self.samples = {}
+        self.started = time.perf_counter()
+        self._stopping = False
+        self._sampler = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.mode == "cprofile":
+            self.loop_profile = cProfile.Profile()
+            self.loop_profile.enable()  # the event loop thread is the one running this
+        else:
+            self._sampler = Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        loop.call_later(min(self.seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS), self.stop)
+
+    def _sample_loop(self):
+        own_id = threading_ident()
+        names = {}
+        while not self._stopping:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names[thread_id] = next((t.name for t in threading_enumerate() if t.ident == thread_id), str(thread_id))
+                folded = ";".join([names[thread_id]] + stack[::-1])
+                self.samples[folded] = self.samples.get(folded, 0) + 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    def tick(self):
+        if self.calls_left is None: return
+        self.calls_left -= 1
+        if self.calls_left <= 0: self.stop()
+
+    def stop(self):
+        global active_profile
+        if self._stopping: return
+        self._stopping = True
+        if active_profile is self: active_profile = None
+        if self.loop_profile: self.loop_profile.disable()
+        spawn_background(self._send_report(), f"profile report ({self.mode})")
+
+    def _build_report(self):
+        elapsed = time.perf_counter() - self.started
+        if self.mode == "cprofile":
+            out = io.StringIO()
+            stats = pstats.Stats(self.loop_profile, stream=out)
+            for profile in list(self.thread_profiles): stats.add(profile)
+            out.write(f"cProfile over {elapsed:.1f}s (event loop + {len(self.thread_profiles)} render jobs)\n\n")
+            stats.sort_stats("cumulative").print_stats(60)
+            stats.sort_stats("tottime").print_stats(40)
+            report = io.BytesIO(out.getvalue().encode())
+            report.name = "profile_stats.txt"
+        else:
+            if self._sampler: self._sampler.join(timeout=2)
+            lines = [f"{stack} {count}" for stack, count in sorted(self.samples.items(), key=lambda s: -s[1])]
+            report = io.BytesIO("\n".join(lines).encode())
+            report.name = "profile_stacks.folded"
+        return report, elapsed
+
+    async def _send_report(self):
+        try:
+            report, elapsed = await asyncio.to_thread(self._build_report)
+            caption = (f"🩺 **Profile finished** ({elapsed:.1f}s)\n"
+                       + ("Sorted by cumulative, then own time." if self.mode == "cprofile"
+                          else "Collapsed stacks - open with speedscope or flamegraph.pl."))
+            await self.client.send_document(self.chat_id, report, caption=caption)
+        except Exception as e:
+            logger.error(f"Could not send profile report: {e}")
+
+def format_handler_stats():
+    if not handler_stats: return "No handler calls recorded yet."
+    lines = ["handler[:state]                          calls   avg ms   max ms  cpu ms/call", "-" * 78]
+    for key, stat in sorted(handler_stats.items(), key=lambda kv: -kv[1]['wall']):
+        n = stat['count']
+        lines.append(f"{key[:40]:<40}{n:>6}{stat['wall'] / n * 1000:>9.1f}{stat['max_wall'] * 1000:>9.1f}{stat['cpu'] / n * 1000:>13.2f}")
+    return "\n".join(lines)
+
 async def shorten_link(user_id: int, long_url: str):
-    user_data = await users_collection.find_one({'_id': user_id})
+    user_data = await get_user_data(user_id)
     if not user_data or 'shortener_api' not in user_data or 'shortener_url' not in user_data:
         return long_url 
 
     api_key = user_data['shortener_api']
     base_url = user_data['shortener_url']
-    api_url = f"https://{base_url}/api?api={api_key}&url={long_url}"
+    if "://" not in base_url: base_url = f"https://{base_url}"
+    api_url = f"{base_url}/api?api={api_key}&url={long_url}"
     
     try:
-        response = requests.get(api_url, timeout=10)
+        response = await asyncio.to_thread(http_session.get, api_url, timeout=10)
         response.raise_for_status()
         data = response.json()
         if data.get("status") == "success" and data.get("shortenedUrl"):
@@ -144,6 +580,328 @@ async def shorten_link(user_id: int, long_url: str):
     except requests.exceptions.RequestException:
         return long_url
 
+# --- OUTBOUND CALL CONTROL (Single-Flight + Rate Limiter) ---
+
+class SingleFlight:
+    """Concurrent calls with the same key share one in-flight task instead of each hitting the network."""
+    def __init__(self):
+        self._inflight = {}  # key -> (task, ticket of the caller that started it)
+
+    async def do(self, key, coro_factory, ticket=None):
+        flight = self._inflight.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(coro_factory())
+            flight = self._inflight[key] = (task, ticket)
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        elif ticket and flight[1]:
+            # A more urgent caller joining must not wait behind the first caller's priority
+            flight[1].raise_to(ticket.priority)
+        # shield: one impatient caller being cancelled must not cancel the call for everyone else
+        return await asyncio.shield(flight[0])
+
+class LimiterTicket:
+    """One acquire() on a PriorityRateLimiter whose priority can still be raised while it waits."""
+    def __init__(self, priority: int):
+        self.priority = priority
+        self._limiter = self._future = None
+
+    def raise_to(self, priority: int):
+        if priority >= self.priority: return
+        self.priority = priority
+        if self._limiter: self._limiter._reprioritise(self)
+
+class PriorityRateLimiter:
+    """Token bucket; when tokens run out, waiters are released by priority (then arrival order)."""
+    def __init__(self, rate: float, burst: int):
+        self.rate, self.capacity = rate, burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._drainer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pending(self, max_priority: int = PRIORITY_BULK):
+        return sum(1 for priority, _, fut in self._waiters if priority <= max_priority and not fut.done())
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, ticket: LimiterTicket = None):
+        if ticket: priority = ticket.priority
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if ticket: ticket._limiter, ticket._future = self, fut
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.ensure_future(self._drain())
+        try:
+            await fut
+        finally:
+            if ticket: ticket._limiter = ticket._future = None
+
+    def _reprioritise(self, ticket: LimiterTicket):
+        for i, (_, seq, fut) in enumerate(self._waiters):
+            if fut is ticket._future:
+                self._waiters[i] = (ticket.priority, seq, fut)
+                heapq.heapify(self._waiters)
+                return
+
+    async def _drain(self):
+        while self._waiters:
+            self._refill()
+            while self._waiters and self.tokens >= 1:
+                _, _, fut = heapq.heappop(self._waiters)
+                if fut.done(): continue  # waiter was cancelled
+                self.tokens -= 1
+                fut.set_result(None)
+            if self._waiters:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+tmdb_flights = SingleFlight()
+tmdb_limiter = PriorityRateLimiter(TMDB_RATE_LIMIT, TMDB_RATE_BURST)
+
+async def tmdb_call(key, func, *args, priority: int = PRIORITY_INTERACTIVE):
+    """Runs a blocking TMDB call off the loop, coalesced by key and gated by the shared limiter."""
+    ticket = LimiterTicket(priority)
+    async def run():
+        await tmdb_limiter.acquire(ticket=ticket)
+        return await asyncio.to_thread(func, *args)
+    result = await tmdb_flights.do(key, run, ticket)
+    # Every caller gets its own copy; handlers mutate details (media_type, poster_file, ...)
+    return copy.deepcopy(result)
+
+class TTLCache:
+    """Small in-memory LRU with per-entry expiry."""
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size, self.ttl = max_size, ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if not entry: return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size: self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+details_cache = TTLCache(DETAILS_CACHE_SIZE, DETAILS_CACHE_TTL)
+
+# --- POSTER CACHE HELPERS ---
+
+_poster_cache_lock = Lock()
+
+def pick_poster_size(target_width: int = POSTER_TARGET_WIDTH, sizes=TMDB_POSTER_SIZES):
+    # Smallest TMDB size that still covers the output width, falling back to the original upload
+    for width, name in sizes:
+        if width >= target_width: return name
+    return "original"
+
+def _poster_cache_paths(image_path: str, size: str):
+    key = hashlib.sha1(f"{size}{image_path}".encode()).hexdigest()
+    base = os.path.join(POSTER_CACHE_DIR, key)
+    return base + ".img", base + ".json"
+
+def _read_poster_meta(meta_path: str):
+    try:
+        with open(meta_path) as f: return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_poster_meta(meta_path: str, meta: dict):
+    tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f: json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+def _evict_poster_cache(keep: str = None):
+    # LRU eviction: hits bump the file mtime, so the oldest mtimes go first
+    budget = POSTER_CACHE_MAX_MB * 1024 * 1024
+    with _poster_cache_lock:
+        entries, total = [], 0
+        for entry in os.scandir(POSTER_CACHE_DIR):
+            if not entry.name.endswith(".img"): continue
+            try: st = entry.stat()
+            except OSError: continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total <= budget: return
+        for _, size, path in sorted(entries):
+            if total <= budget: break
+            if path == keep: continue
+            for stale in (path, path[:-4] + ".json"):
+                try: os.remove(stale)
+                except OSError: pass
+            total -= size
+
+def cached_poster(image_path: str, size: str = None):
+    """Returns the local file for a TMDB image if a fresh copy is on disk, without touching the network."""
+    img_path, meta_path = _poster_cache_paths(image_path, size or pick_poster_size())
+    meta = _read_poster_meta(meta_path) if os.path.exists(img_path) else None
+    if meta and time.time() - meta.get("checked_at", 0) < POSTER_CACHE_TTL:
+        try: os.utime(img_path)
+        except OSError: return None  # evicted in between
+        return img_path
+    return None
+
+def fetch_poster(image_path: str, size: str = None):
+    """Returns a local file path for a TMDB image, downloading or revalidating it only when needed."""
+    if not image_path: return None
+    size = size or pick_poster_size()
+    fresh = cached_poster(image_path, size)
+    if fresh: return fresh
+    img_path, meta_path = _poster_cache_paths(image_path, size)
+    meta = _read_poster_meta(meta_path) if os.path.exists(img_path) else None
+
+    headers = {}
+    if meta and meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"): headers["If-Modified-Since"] = meta["last_modified"]
+
+    tmp_path = f"{img_path}.{os.getpid()}.{threading_ident()}.tmp"
+    try:
+        with http_session.get(f"{TMDB_IMAGE_BASE}/{size}{image_path}", headers=headers, timeout=20, stream=True) as r:
+            if r.status_code == 304 and meta:
+                meta["checked_at"] = time.time()
+                _write_poster_meta(meta_path, meta)
+                os.utime(img_path)
+                return img_path
+            r.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024): f.write(chunk)
+            os.replace(tmp_path, img_path)
+            _write_poster_meta(meta_path, {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "checked_at": time.time(),
+            })
+    except Exception as e:
+        logger.warning(f"Poster download failed for {image_path} ({size}): {e}")
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        # A stale copy is still better than no poster at all
+        return img_path if meta else None
+
+    _evict_poster_cache(keep=img_path)
+    return img_path
+
+def load_poster_analysis(poster_input):
+    """Precomputed faces/colour for a poster-cache file, if the prefetcher already analysed it."""
+    if not isinstance(poster_input, str) or not poster_input.endswith(".img"): return None
+    meta = _read_poster_meta(poster_input[:-4] + ".json")
+    return meta.get("analysis") if meta else None
+
+def save_poster_analysis(img_path: str, analysis: dict):
+    meta_path = img_path[:-4] + ".json"
+    meta = _read_poster_meta(meta_path)
+    if meta is None: return
+    meta["analysis"] = analysis  # a fresh download rewrites the meta, which drops stale analysis with it
+    _write_poster_meta(meta_path, meta)
+
+async def get_poster_file(image_path: str, size: str = None, priority: int = PRIORITY_INTERACTIVE):
+    if not image_path: return None
+    size = size or pick_poster_size()
+    fresh = await asyncio.to_thread(cached_poster, image_path, size)
+    if fresh: return fresh
+    return await tmdb_call(("image", size, image_path), fetch_poster, image_path, size, priority=priority)
+
+# --- POSTER BUFFER MANAGEMENT ---
+
+class MemoryBudget:
+    """Accounts for the memory in-flight renders need; new renders queue while the budget is spent."""
+    def __init__(self, limit_bytes: int):
+        self.limit = limit_bytes
+        self.used = self.peak = self.waiting = self.refused = 0
+        self._cond = None
+
+    def _condition(self):
+        if self._cond is None: self._cond = asyncio.Condition()  # created on the running loop
+        return self._cond
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes: int, timeout: float = RENDER_QUEUE_TIMEOUT):
+        cond = self._condition()
+        async with cond:
+            self.waiting += 1
+            try:
+                # A single oversized render may still run, just never alongside anything else
+                await asyncio.wait_for(cond.wait_for(lambda: self.used == 0 or self.used + nbytes <= self.limit), timeout)
+            except asyncio.TimeoutError:
+                self.refused += 1
+                raise
+            finally:
+                self.waiting -= 1
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+        try:
+            yield
+        finally:
+            async with cond:
+                self.used -= nbytes
+                cond.notify_all()
+
+render_memory = MemoryBudget(RENDER_MEMORY_BUDGET_MB * 1024 * 1024)
+
+def spool_path(suffix: str = ".png"):
+    fd, path = tempfile.mkstemp(prefix="poster_", suffix=suffix, dir=POSTER_SPOOL_DIR)
+    os.close(fd)
+    return path
+
+def spool_blob(buffer: io.BytesIO, name: str = "final_poster.png"):
+    """Keeps small blobs in memory and moves bigger ones to a spool file. Returns a BytesIO or a file path."""
+    if buffer.getbuffer().nbytes <= POSTER_SPOOL_THRESHOLD:
+        buffer.name = name
+        buffer.seek(0)
+        return buffer
+    path = spool_path(os.path.splitext(name)[1])
+    with open(path, 'wb') as f: f.write(buffer.getbuffer())
+    buffer.close()
+    return path
+
+def rewind_blob(blob):
+    # Spooled blobs are plain paths and need no rewinding
+    if hasattr(blob, "seek"): blob.seek(0)
+    return blob
+
+def discard_blob(blob):
+    if isinstance(blob, str) and os.path.dirname(os.path.abspath(blob)) == os.path.abspath(POSTER_SPOOL_DIR):
+        try: os.remove(blob)
+        except OSError: pass
+    elif hasattr(blob, "close"):
+        blob.close()
+
+def clear_conversation(uid: int):
+    """Drops a user's session and deletes any poster files it spooled to disk."""
+    convo = user_conversations.pop(uid, None)
+    if not convo: return
+    discard_blob((convo.get('details') or {}).get('poster_file'))
+    final_post = convo.get('final_post') or {}
+    for blob in [final_post.get('poster')] + list(final_post.get('album') or []):
+        if blob is not None: discard_blob(blob)
+
+def sweep_spool_dir(max_age: int = POSTER_SPOOL_MAX_AGE):
+    cutoff = time.time() - max_age
+    for entry in os.scandir(POSTER_SPOOL_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff: os.remove(entry.path)
+        except OSError: pass
+
+async def spool_janitor():
+    while True:
+        await asyncio.to_thread(sweep_spool_dir)
+        await asyncio.sleep(max(60, POSTER_SPOOL_MAX_AGE // 4))
+
 def format_runtime(minutes: int):
     if not minutes or not isinstance(minutes, int): return "N/A"
     hours, mins = divmod(minutes, 60)
@@ -151,48 +909,210 @@ def format_runtime(minutes: int):
 
 # ---- 3. TMDB API & CONTENT GENERATION ----
 
-def search_tmdb_by_imdb(imdb_id: str):
-    url = f"https://api.themoviedb.org/3/find/{imdb_id}?api_key={TMDB_API_KEY}&external_source=imdb_id"
+def _tmdb_get(path: str, **params):
+    params["api_key"] = TMDB_API_KEY
+    r = http_session.get(f"{TMDB_API_BASE}{path}", params=params, timeout=10)
+    r.raise_for_status()
+    return r.json()
+
+def _find_by_imdb(imdb_id: str):
     try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        data = r.json()
+        data = _tmdb_get(f"/find/{imdb_id}", external_source="imdb_id")
         return data.get("movie_results", []) + data.get("tv_results", [])
     except Exception:
         return []
 
-def search_tmdb(query: str):
-    year, name = None, query.strip()
-    match = re.search(r'(.+?)\s*\(?(\d{4})\)?$', query)
-    if match: name, year = match.group(1).strip(), match.group(2)
-    url = f"https://api.themoviedb.org/3/search/multi?api_key={TMDB_API_KEY}&query={name}" + (f"&year={year}" if year else "")
+def _search_multi(name: str, year: str = None):
     try:
-        r = requests.get(url, timeout=10); r.raise_for_status()
-        return [res for res in r.json().get("results", []) if res.get("media_type") in ["movie", "tv"]][:5]
+        params = {"query": name}
+        if year: params["year"] = year
+        results = _tmdb_get("/search/multi", **params).get("results", [])
+        return [res for res in results if res.get("media_type") in ["movie", "tv"]][:5]
     except Exception:
         return []
 
-def get_tmdb_details(media_type: str, media_id: int):
-    url = f"https://api.themoviedb.org/3/{media_type}/{media_id}?api_key={TMDB_API_KEY}&append_to_response=credits"
+def _fetch_list(path: str):
     try:
-        r = requests.get(url, timeout=10); r.raise_for_status(); return r.json()
+        return _tmdb_get(path).get("results", [])
+    except Exception:
+        return []
+
+def _fetch_details(media_type: str, media_id: int):
+    try:
+        return _tmdb_get(f"/{media_type}/{media_id}", append_to_response="credits,images", include_image_language="en,null")
     except Exception:
         return None
 
+async def search_tmdb_by_imdb(imdb_id: str, priority: int = PRIORITY_INTERACTIVE):
+    return await tmdb_call(("find", imdb_id), _find_by_imdb, imdb_id, priority=priority)
+
+async def search_tmdb(query: str, priority: int = PRIORITY_INTERACTIVE):
+    year, name = None, query.strip()
+    match = re.search(r'(.+?)\s*\(?(\d{4})\)?$', query)
+    if match: name, year = match.group(1).strip(), match.group(2)
+    return await tmdb_call(("search", name.lower(), year), _search_multi, name, year, priority=priority)
+
+async def get_tmdb_details(media_type: str, media_id: int, priority: int = PRIORITY_INTERACTIVE):
+    key = ("details", media_type, int(media_id))
+    cached = details_cache.get(key)
+    if cached is not None: return copy.deepcopy(cached)
+    details = await tmdb_call(key, _fetch_details, media_type, media_id, priority=priority)
+    if details: details_cache.set(key, copy.deepcopy(details))
+    return details
+
+async def get_tmdb_list(path: str, priority: int = PRIORITY_BACKGROUND):
+    return await tmdb_call(("list", path), _fetch_list, path, priority=priority)
+
+# --- BADGE PLACEMENT ENGINE ---
+
+_cascade_local = thread_local()  # CascadeClassifier isn't safe to share between render threads
+_cascade_retry_at = 0
+
+def get_face_cascade():
+    global _cascade_retry_at
+    cascade = getattr(_cascade_local, "cascade", None)
+    if cascade is not None or time.time() < _cascade_retry_at: return cascade
+    cascade_path = download_cascade()
+    if cascade_path:
+        cascade = cv2.CascadeClassifier(cascade_path)
+        if not cascade.empty():
+            _cascade_local.cascade = cascade
+            return cascade
+    _cascade_retry_at = time.time() + 600  # don't hammer GitHub on every render while it's unreachable
+    return None
+
+def detect_faces(gray, bands=None):
+    """Runs Haar detection on a (downscaled) grayscale array, optionally only inside the given (y0, y1) row bands."""
+    cascade = get_face_cascade()
+    if cascade is None: return []
+    height = gray.shape[0]
+    faces = []
+    for y0, y1 in (bands or [(0, height)]):
+        y0, y1 = max(0, int(y0)), min(height, int(y1))
+        if y1 - y0 < 20: continue
+        found = cascade.detectMultiScale(gray[y0:y1], scaleFactor=1.1, minNeighbors=5, minSize=(20, 20))
+        faces.extend((int(fx), int(fy) + y0, int(fw), int(fh)) for (fx, fy, fw, fh) in found)
+    return faces
+
+def _merge_bands(bands):
+    merged = []
+    for y0, y1 in sorted(bands):
+        if merged and y0 <= merged[-1][1]: merged[-1][1] = max(merged[-1][1], y1)
+        else: merged.append([y0, y1])
+    return merged
+
+def badge_candidates(img_w: int, img_h: int, box_w: int, box_h: int, watermark_top: float = None):
+    """Candidate top-left corners for the badge box, each with a small preference penalty (top-centre is the classic spot)."""
+    bottom_limit = watermark_top if watermark_top is not None else img_h * 0.95
+    rows = [
+        (img_h * 0.03, 0.0),                           # top
+        (img_h * 0.25, 0.05),                          # upper area (old fallback)
+        (img_h / 3 - box_h / 2, 0.08),                 # upper third
+        (bottom_limit - box_h - img_h * 0.02, 0.12),   # bottom, just above the watermark
+    ]
+    cols = [((img_w - box_w) / 2, 0.0)]
+    if box_w < img_w * 0.8:
+        cols += [(img_w * 0.04, 0.04), (img_w - box_w - img_w * 0.04, 0.04)]
+    return [(x, y, row_pen + col_pen) for y, row_pen in rows if 0 <= y <= img_h - box_h for x, col_pen in cols]
+
+def choose_badge_position(original_img, box_w: int, box_h: int, watermark_top: float = None, faces=None):
+    """Scores every candidate slot by face overlap and local busyness and returns the best (x, y) in full-size pixels.
+
+    `faces` may carry precomputed boxes in full-size pixels; otherwise detection runs on a downscaled copy,
+    restricted to the rows the candidates cover.
+    """
+    img_w, img_h = original_img.size
+    candidates = badge_candidates(img_w, img_h, box_w, box_h, watermark_top)
+    if not candidates: return (img_w - box_w) / 2, img_h * 0.03
+
+    scale = min(1.0, BADGE_DETECT_WIDTH / img_w)
+    small = original_img.resize((max(1, int(img_w * scale)), max(1, int(img_h * scale))), Image.BILINEAR).convert("L")
+    gray = np.asarray(small)
+
+    if faces is None:
+        # Pad each band by a box height so faces straddling the band edge are still found
+        bands = _merge_bands([((y - box_h) * scale, (y + 2 * box_h) * scale) for _, y, _ in candidates])
+        faces = [(fx / scale, fy / scale, fw / scale, fh / scale) for fx, fy, fw, fh in detect_faces(gray, bands)]
+
+    # Busyness = mean gradient magnitude, read in O(1) per slot from an integral image
+    g = gray.astype(np.float32)
+    grad = np.zeros_like(g)
+    grad[:, 1:] += np.abs(np.diff(g, axis=1))
+    grad[1:, :] += np.abs(np.diff(g, axis=0))
+    integral = np.zeros((g.shape[0] + 1, g.shape[1] + 1), dtype=np.float64)
+    integral[1:, 1:] = grad.cumsum(axis=0).cumsum(axis=1)
+
+    def busyness(x, y):
+        # A centred badge wider than the poster starts left of 0; clamp so the integral lookup doesn't wrap around
+        x0 = max(0, min(int(x * scale), gray.shape[1] - 1))
+        y0 = max(0, min(int(y * scale), gray.shape[0] - 1))
+        x1 = min(gray.shape[1], max(x0 + 1, int((x + box_w) * scale)))
+        y1 = min(gray.shape[0], max(y0 + 1, int((y + box_h) * scale)))
+        total = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+        return total / ((x1 - x0) * (y1 - y0) * 255.0)
+
+    def face_overlap(x, y):
+        area = 0.0
+        for fx, fy, fw, fh in faces:
+            ox = min(x + box_w, fx + fw) - max(x, fx)
+            oy = min(y + box_h, fy + fh) - max(y, fy)
+            if ox > 0 and oy > 0: area += ox * oy
+        return area / (box_w * box_h)
+
+    best = min(candidates, key=lambda c: 10 * face_overlap(c[0], c[1]) + busyness(c[0], c[1]) + c[2])
+    return best[0], best[1]
+
+def dominant_colour(img):
+    thumbnail = img.resize((150, 150))
+    colors = thumbnail.getcolors(150*150)
+    if not colors: return None
+    return list(sorted(colors, key=lambda x: x[0], reverse=True)[0][1][:3])
+
+def analyze_poster(img_path: str):
+    """Full-frame face boxes (full-size pixels) and dominant colour, for caching next to the poster.
+
+    Without a cascade the "faces" key is left out, so watermark_poster still detects live later
+    instead of trusting an empty list.
+    """
+    with Image.open(img_path) as im:
+        original_img = im.convert("RGBA")
+    analysis = {"dominant": dominant_colour(original_img)}
+    if get_face_cascade() is None: return analysis
+    scale = min(1.0, BADGE_DETECT_WIDTH / original_img.width)
+    small = original_img.resize((max(1, int(original_img.width * scale)), max(1, int(original_img.height * scale))), Image.BILINEAR).convert("L")
+    analysis["faces"] = [[fx / scale, fy / scale, fw / scale, fh / scale] for fx, fy, fw, fh in detect_faces(np.asarray(small))]
+    return analysis
+
 def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
-    # poster_input can be a String (URL) or BytesIO (File)
+    # poster_input can be a URL, a local file path (poster cache) or BytesIO (File)
     if not poster_input: return None, "Poster not found."
     try:
-        if isinstance(poster_input, str):
-            img_data = requests.get(poster_input, timeout=20).content
+        if isinstance(poster_input, str) and poster_input.startswith(("http://", "https://")):
+            img_data = http_session.get(poster_input, timeout=20).content
             original_img = Image.open(io.BytesIO(img_data)).convert("RGBA")
         else:
             original_img = Image.open(poster_input).convert("RGBA")
+        analysis = load_poster_analysis(poster_input) or {}
         
-        img = Image.new("RGBA", original_img.size)
-        img.paste(original_img)
+        img = original_img  # convert() already returned a fresh copy we can draw on
         draw = ImageDraw.Draw(img)
 
+        # ---- Watermark Layout (needed first so the badge can stay clear of it) ----
+        watermark_top = None
+        if watermark_text:
+            # Colour comes from the untouched poster so it can be precomputed by the prefetcher
+            dominant_color = analysis.get("dominant") or dominant_colour(original_img)
+            font_size = int(img.width / 12)
+            try:
+                font = ImageFont.truetype("Poppins-Bold.ttf", font_size)
+            except IOError:
+                font = ImageFont.load_default()
+            wm_bbox = draw.textbbox((0, 0), watermark_text, font=font)
+            wm_width, wm_height = wm_bbox[2] - wm_bbox[0], wm_bbox[3] - wm_bbox[1]
+            wx = (img.width - wm_width) / 2
+            wy = img.height - wm_height - (img.height * 0.05)
+            watermark_top = wy
+
         # ---- Badge Text Logic ----
         if badge_text:
             badge_font_size = int(img.width / 9)
@@ -204,45 +1124,32 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
             bbox = draw.textbbox((0, 0), badge_text, font=badge_font)
             text_width = bbox[2] - bbox[0]
             text_height = bbox[3] - bbox[1]
-            x = (img.width - text_width) / 2
-            
-            # --- Face Detection Logic ---
-            y_pos = img.height * 0.03
-            cascade_path = download_cascade()
-            if cascade_path:
-                try:
-                    cv_image = np.array(original_img.convert('RGB'))
-                    gray = cv2.cvtColor(cv_image, cv2.COLOR_RGB2GRAY)
-                    face_cascade = cv2.CascadeClassifier(cascade_path)
-                    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-                    
-                    padding = int(badge_font_size * 0.2)
-                    text_box_y1 = y_pos + text_height + padding
-                    is_collision = any(y_pos < (fy + fh) and text_box_y1 > fy for (fx, fy, fw, fh) in faces)
-                    
-                    if is_collision:
-                        y_pos = img.height * 0.25
-                except Exception: pass
-
-            y = y_pos
             padding = int(badge_font_size * 0.1)
+            
+            # --- Smart Placement (face + busyness aware) ---
+            try:
+                bx, by = choose_badge_position(original_img, text_width + 2 * padding, text_height + 2 * padding, watermark_top, faces=analysis.get("faces"))
+                x, y = bx + padding, by + padding
+            except Exception as e:
+                logger.warning(f"Badge placement failed, using default spot: {e}")
+                x, y = (img.width - text_width) / 2, img.height * 0.03
+
             rect_layer = Image.new('RGBA', img.size, (0, 0, 0, 0))
             rect_draw = ImageDraw.Draw(rect_layer)
             rect_draw.rectangle((x - padding, y - padding, x + text_width + padding, y + text_height + padding), fill=(0, 0, 0, 140))
             img = Image.alpha_composite(img, rect_layer)
+            del rect_layer, rect_draw
             draw = ImageDraw.Draw(img)
 
-            gradient = Image.new('RGBA', (text_width, text_height), (0, 0, 0, 0))
-            gradient_draw = ImageDraw.Draw(gradient)
-            
-            gradient_start_color = (255, 255, 0)
-            gradient_end_color = (255, 20, 0)
-            for i in range(text_width):
-                ratio = i / text_width
-                r = int(gradient_start_color[0] * (1 - ratio) + gradient_end_color[0] * ratio)
-                g = int(gradient_start_color[1] * (1 - ratio) + gradient_end_color[1] * ratio)
-                b = int(gradient_start_color[2] * (1 - ratio) + gradient_end_color[2] * ratio)
-                gradient_draw.line([(i, 0), (i, text_height)], fill=(r, g, b, 255))
+            # Horizontal yellow -> red gradient, built in one go instead of line by line
+            ratio = np.linspace(0, 1, text_width, endpoint=False, dtype=np.float32)[None, :, None]
+            start_color = np.array([255, 255, 0], dtype=np.float32)
+            end_color = np.array([255, 20, 0], dtype=np.float32)
+            row = (start_color * (1 - ratio) + end_color * ratio).astype(np.uint8)
+            rgb = np.repeat(row, text_height, axis=0)
+            alpha = np.full((text_height, text_width, 1), 255, dtype=np.uint8)
+            gradient = Image.fromarray(np.concatenate([rgb, alpha], axis=2), 'RGBA')
+            del rgb, alpha, row
             
             mask = Image.new('L', (text_width, text_height), 0)
             mask_draw = ImageDraw.Draw(mask)
@@ -251,23 +1158,10 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
 
         # ---- Watermark Logic ----
         if watermark_text:
-            font_size = int(img.width / 12)
-            try:
-                font = ImageFont.truetype("Poppins-Bold.ttf", font_size)
-            except IOError:
-                font = ImageFont.load_default()
-            
-            thumbnail = img.resize((150, 150))
-            colors = thumbnail.getcolors(150*150)
             text_color = (255, 255, 255, 230)
-            if colors:
-                dominant_color = sorted(colors, key=lambda x: x[0], reverse=True)[0][1]
+            if dominant_color:
                 text_color = (255 - dominant_color[0], 255 - dominant_color[1], 255 - dominant_color[2], 230)
 
-            bbox = draw.textbbox((0, 0), watermark_text, font=font)
-            text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
-            wx = (img.width - text_width) / 2
-            wy = img.height - text_height - (img.height * 0.05)
             draw.text((wx + 2, wy + 2), watermark_text, font=font, fill=(0, 0, 0, 128))
             draw.text((wx, wy), watermark_text, font=font, fill=text_color)
             
@@ -279,6 +1173,248 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
     except Exception as e:
         return None, f"Image processing error. Error: {e}"
 
+def estimate_render_bytes(poster_input):
+    # Decoded RGBA frame (4 bytes/px) times the ~4 full-size images alive at once during a render
+    try:
+        if isinstance(poster_input, str) and poster_input.startswith(("http://", "https://")): raise ValueError
+        with Image.open(poster_input) as im: width, height = im.size  # reads the header only
+        rewind_blob(poster_input)
+    except Exception:
+        width, height = POSTER_TARGET_WIDTH, int(POSTER_TARGET_WIDTH * 1.5)
+    return width * height * 4 * 4
+
+def _render_to_blob(poster_input, watermark_text: str, badge_text: str = None):
+    buffer, error = watermark_poster(poster_input, watermark_text, badge_text)
+    return (spool_blob(buffer) if buffer else None), error
+
+async def render_poster(poster_input, watermark_text: str, badge_text: str = None):
+    """Renders on the render pool once the memory budget allows. Returns (BytesIO or spool path, error)."""
+    # Pillow/OpenCV release the GIL for the heavy parts, so renders really do run side by side here
+    loop = asyncio.get_running_loop()
+    try:
+        async with render_memory.reserve(estimate_render_bytes(poster_input)):
+            return await loop.run_in_executor(render_executor, run_profiled, _render_to_blob, poster_input, watermark_text, badge_text)
+    except asyncio.TimeoutError:
+        return None, "Server is busy right now, please try again in a minute."
+
+def pick_backdrops(details: dict, count: int):
+    backdrops = (details.get("images") or {}).get("backdrops") or []
+    backdrops = sorted(backdrops, key=lambda b: b.get("vote_average", 0), reverse=True)
+    paths = [b["file_path"] for b in backdrops if b.get("file_path")]
+    if not paths and details.get("backdrop_path"): paths = [details["backdrop_path"]]
+    return paths[:count]
+
+async def build_album(details: dict, watermark_text: str, badge_text: str, backdrop_count: int):
+    """Downloads and renders the poster plus backdrops concurrently; each image starts rendering as soon as it lands.
+
+    Returns (poster_blob, backdrop_blobs). If the poster fails the backdrops are discarded and (None, []) is returned.
+    """
+    backdrop_size = pick_poster_size(BACKDROP_TARGET_WIDTH, TMDB_BACKDROP_SIZES)
+
+    async def fetch_and_render(image_path, size, badge):
+        local_file = await get_poster_file(image_path, size)
+        if not local_file: return None
+        buffer, error = await render_poster(local_file, watermark_text, badge_text=badge)
+        if error: logger.warning(f"Album image {image_path} failed: {error}")
+        return buffer
+
+    poster, *backdrops = await asyncio.gather(
+        fetch_and_render(details["poster_path"], None, badge_text),
+        *(fetch_and_render(path, backdrop_size, None) for path in pick_backdrops(details, backdrop_count)))
+    backdrops = [buffer for buffer in backdrops if buffer]
+    if not poster:
+        # A backdrop must never lead the post; let the caller fall back to the single-poster path
+        for buffer in backdrops: discard_blob(buffer)
+        return None, []
+    return poster, backdrops
+
+async def send_final_post(client, chat_id, final_post: dict):
+    """Sends a finished post (album, single poster or text) and returns the messages sent."""
+    caption = final_post['caption']
+    album = final_post.get('album')
+    if album:
+        media = []
+        for i, blob in enumerate(album):
+            media.append(InputMediaPhoto(rewind_blob(blob), caption=caption if i == 0 else "", parse_mode=enums.ParseMode.MARKDOWN))
+        return await client.send_media_group(chat_id, media)
+    if final_post['poster']:
+        return [await client.send_photo(chat_id, photo=rewind_blob(final_post['poster']), caption=caption, parse_mode=enums.ParseMode.MARKDOWN)]
+    return [await client.send_message(chat_id, caption, parse_mode=enums.ParseMode.MARKDOWN)]
+
+# --- SCHEDULED POSTING QUEUE ---
+
+def utcnow():
+    # Mongo hands datetimes back as naive UTC, so keep everything in that form
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def parse_schedule_time(text: str):
+    """Accepts `+30m` / `2h` / `1d`, `HH:MM` (next occurrence) or `YYYY-MM-DD HH:MM`, in SCHEDULE_TZ. Returns naive UTC."""
+    text = (text or "").strip().lower()
+    match = re.fullmatch(r'\+?(\d+)\s*([mhd])', text)
+    if match:
+        unit = {'m': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+        return utcnow() + timedelta(**{unit: int(match.group(1))})
+    now_local = datetime.now(SCHEDULE_TZ)
+    try:
+        if re.fullmatch(r'\d{1,2}:\d{2}', text):
+            clock = datetime.strptime(text, "%H:%M")
+            due = now_local.replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0)
+            if due <= now_local: due += timedelta(days=1)
+        else:
+            due = datetime.strptime(text, "%Y-%m-%d %H:%M").replace(tzinfo=SCHEDULE_TZ)
+    except ValueError:
+        return None
+    return due.astimezone(timezone.utc).replace(tzinfo=None)
+
+async def schedule_post(uid: int, channel_id: str, final_post: dict, due_at: datetime):
+    result = await scheduled_collection.insert_one({
+        'user_id': uid,
+        'chat_id': int(channel_id),
+        'caption': final_post['caption'],
+        'file_ids': final_post.get('file_ids', []),  # Telegram keeps the rendered photos, we only keep references
+        'due_at': due_at,
+        'status': 'pending',
+        'attempts': 0,
+        'created_at': utcnow(),
+    })
+    return result.inserted_id
+
+async def send_scheduled_job(client, job: dict):
+    chat_id, caption, file_ids = job['chat_id'], job['caption'], job.get('file_ids') or []
+    if len(file_ids) > 1:
+        media = [InputMediaPhoto(fid, caption=caption if i == 0 else "", parse_mode=enums.ParseMode.MARKDOWN) for i, fid in enumerate(file_ids)]
+        await client.send_media_group(chat_id, media)
+    elif file_ids:
+        await client.send_photo(chat_id, file_ids[0], caption=caption, parse_mode=enums.ParseMode.MARKDOWN)
+    else:
+        await client.send_message(chat_id, caption, parse_mode=enums.ParseMode.MARKDOWN)
+
+chat_next_send = {}  # chat_id -> time.monotonic() before which nothing more is posted there
+
+async def _run_scheduled_job(client, job: dict):
+    """Sends one job and records its outcome (done, retry later, or failed)."""
+    attempts = job.get('attempts', 0)
+    try:
+        await send_scheduled_job(client, job)
+    except FloodWait as e:
+        # Not the job's fault: put it back without using up an attempt, and don't hold a batch slot while waiting
+        retry_at = utcnow() + timedelta(seconds=e.value)
+        logger.warning(f"FloodWait in {job['chat_id']}, rescheduling in {e.value}s")
+        chat_next_send[job['chat_id']] = time.monotonic() + e.value  # the rest of the chat waits too
+        await scheduled_collection.update_one({'_id': job['_id']}, {'$set': {'status': 'pending', 'due_at': retry_at, 'last_error': f"FloodWait {e.value}s"}})
+        return
+    except Exception as e:
+        attempts += 1
+        error = str(e)
+    else:
+        # Telegram already has the post: a failed status write must not send it again
+        try: await scheduled_collection.update_one({'_id': job['_id']}, {'$set': {'status': 'done', 'sent_at': utcnow()}})
+        except Exception as e: logger.error(f"Scheduled post {job['_id']} was sent but not marked done: {e}")
+        return
+
+    if attempts < SCHEDULE_MAX_ATTEMPTS:
+        retry_at = utcnow() + timedelta(seconds=60 * 2 ** attempts)
+        await scheduled_collection.update_one({'_id': job['_id']}, {'$set': {'status': 'pending', 'due_at': retry_at, 'attempts': attempts, 'last_error': error}})
+        return
+    await scheduled_collection.update_one({'_id': job['_id']}, {'$set': {'status': 'failed', 'attempts': attempts, 'last_error': error}})
+    try: await client.send_message(job['user_id'], f"❌ **Scheduled post to** `{job['chat_id']}` **failed.**\nError: `{error}`")
+    except Exception: pass
+
+async def dispatch_due_posts(client):
+    """Claims due jobs, at most one per chat that may post again, and sends them in parallel. Returns how many were claimed."""
+    now, clock = utcnow(), time.monotonic()
+    for chat_id in [chat_id for chat_id, at in chat_next_send.items() if at <= clock]: del chat_next_send[chat_id]
+    # Chats still inside SCHEDULE_CHAT_INTERVAL (or a FloodWait) keep their jobs queued; pacing holds across batches
+    busy = set(chat_next_send)
+    jobs = []
+    while len(jobs) < SCHEDULE_BATCH_SIZE:
+        candidates = await scheduled_collection.find({'status': 'pending', 'due_at': {'$lte': now}, 'chat_id': {'$nin': list(busy)}}).sort('due_at', 1).to_list(SCHEDULE_BATCH_SIZE)
+        candidates = [candidate for candidate in candidates if candidate['chat_id'] not in busy]
+        if not candidates: break
+        for candidate in candidates:
+            if candidate['chat_id'] in busy or len(jobs) >= SCHEDULE_BATCH_SIZE: continue
+            busy.add(candidate['chat_id'])
+            # Claim one by one: a job deleted (/unschedule) or taken since the read must not be sent
+            job = await scheduled_collection.find_one_and_update(
+                {'_id': candidate['_id'], 'status': 'pending'}, {'$set': {'status': 'sending', 'claimed_at': now}},
+                return_document=ReturnDocument.AFTER)
+            if job: jobs.append(job)
+
+    semaphore = asyncio.Semaphore(SCHEDULE_CONCURRENCY)
+    async def send(job):
+        async with semaphore:
+            await _run_scheduled_job(client, job)
+            next_send = time.monotonic() + SCHEDULE_CHAT_INTERVAL
+            chat_next_send[job['chat_id']] = max(chat_next_send.get(job['chat_id'], 0), next_send)
+    await asyncio.gather(*(send(job) for job in jobs))
+    return len(jobs)
+
+async def scheduled_post_dispatcher(client):
+    # Anything left in 'sending' was cut off by a restart; send it again rather than lose it
+    await scheduled_collection.update_many({'status': 'sending'}, {'$set': {'status': 'pending'}})
+    while True:
+        try:
+            claimed = await dispatch_due_posts(client)
+        except Exception as e:
+            logger.error(f"Scheduled post dispatcher error: {e}")
+            claimed = 0
+        if claimed < SCHEDULE_BATCH_SIZE:
+            # Come back as soon as a paced chat may post again, or at the regular poll
+            wait = SCHEDULE_POLL_INTERVAL
+            if chat_next_send: wait = min(wait, max(0.5, min(chat_next_send.values()) - time.monotonic()))
+            await asyncio.sleep(wait)
+
+# --- TRENDING PREFETCH ---
+
+async def wait_until_idle(deadline: float):
+    # Idle = no render holding memory and no interactive TMDB call waiting for a token
+    while time.monotonic() < deadline:
+        if render_memory.used == 0 and render_memory.waiting == 0 and tmdb_limiter.pending(PRIORITY_INTERACTIVE) == 0:
+            return True
+        await asyncio.sleep(1)
+    return False
+
+async def prefetch_title(media_type: str, media_id: int):
+    details = await get_tmdb_details(media_type, media_id, priority=PRIORITY_BACKGROUND)
+    if not details or not details.get("poster_path"): return False
+    img_path = await get_poster_file(details["poster_path"], priority=PRIORITY_BACKGROUND)
+    if img_path and "faces" not in (load_poster_analysis(img_path) or {}):
+        loop = asyncio.get_running_loop()
+        analysis = await loop.run_in_executor(render_executor, run_profiled, analyze_poster, img_path)
+        await asyncio.to_thread(save_poster_analysis, img_path, analysis)
+    return True
+
+async def prefetch_trending(max_titles: int = PREFETCH_MAX_TITLES, time_budget: int = PREFETCH_TIME_BUDGET):
+    """Warms the details cache, poster cache and poster analysis for what is trending right now."""
+    deadline = time.monotonic() + time_budget
+    titles, seen = [], set()
+    for path in PREFETCH_LISTS:
+        for item in await get_tmdb_list(path):
+            media_type = item.get("media_type") or path.split("/")[1]
+            key = (media_type, item.get("id"))
+            if media_type in ("movie", "tv") and item.get("id") and key not in seen:
+                seen.add(key)
+                titles.append(key)
+
+    warmed = 0
+    for media_type, media_id in titles[:max_titles]:
+        if not await wait_until_idle(deadline): break
+        try:
+            if await prefetch_title(media_type, media_id): warmed += 1
+        except Exception as e:
+            logger.warning(f"Prefetch of {media_type}/{media_id} failed: {e}")
+    return warmed
+
+async def trending_prefetcher():
+    if PREFETCH_MAX_TITLES <= 0: return
+    while True:
+        try:
+            warmed = await prefetch_trending()
+            logger.info(f"🔥 Prefetched {warmed} trending titles.")
+        except Exception as e:
+            logger.error(f"Trending prefetcher error: {e}")
+        await asyncio.sleep(PREFETCH_INTERVAL)
+
 async def generate_channel_caption(data: dict, language: str, links: dict, user_data: dict):
     # Determine Genre
     if isinstance(data.get("genres"), list) and len(data["genres"]) > 0:
@@ -360,6 +1496,8 @@ https://t.me/+GL_XAS4MsJg4ODM1"""
 # ---- 4. BOT HANDLERS (UPDATED START & PREMIUM LOGIC) ----
 
 @bot.on_message(filters.command("start") & filters.private)
+@serialize_per_user
+@track_handler("start_cmd")
 @force_subscribe
 async def start_cmd(client, message: Message):
     user = message.from_user
@@ -367,7 +1505,7 @@ async def start_cmd(client, message: Message):
     await add_user_to_db(user)
     
     # Clean up previous states
-    if uid in user_conversations: del user_conversations[uid]
+    clear_conversation(uid)
 
     is_premium = await is_user_premium(uid)
     is_owner = (uid == OWNER_ID)
@@ -413,6 +1551,8 @@ async def start_cmd(client, message: Message):
 
 # --- CALLBACK QUERY HANDLER FOR MENUS ---
 @bot.on_callback_query(filters.regex(r"^(admin_|my_account|help_guide|back_home)"))
+@serialize_per_user
+@track_handler("menu_callbacks")
 async def menu_callbacks(client, cb: CallbackQuery):
     data = cb.data
     uid = cb.from_user.id
@@ -434,9 +1574,13 @@ async def menu_callbacks(client, cb: CallbackQuery):
             "🔹 `/post <Link>` - Create post by TMDB Link.\n"
             "🔹 `/badge <Text>` - Add badge to poster.\n"
             "🔹 `/settings` - Manage watermark & shortener.\n"
-            "🔹 `/addchannel <ID>` - Add channel (-100...).\n\n"
+            "🔹 `/setalbum <N>` - Post poster + N backdrops as an album.\n"
+            "🔹 `/addchannel <ID>` - Add channel (-100...).\n"
+            "🔹 `/scheduled` - List scheduled posts.\n"
+            "🔹 `/unschedule <ID>` - Cancel a scheduled post.\n\n"
             "**For Admins:**\n"
-            "Use the buttons in `/start` menu."
+            "Use the buttons in `/start` menu.\n"
+            "🔹 `/profile` - Profile the bot (owner only)."
         )
         await cb.message.edit_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="back_home")]]))
 
@@ -446,6 +1590,7 @@ async def menu_callbacks(client, cb: CallbackQuery):
             return await cb.answer("❌ You are not the Admin!", show_alert=True)
 
         if data == "admin_stats":
+            await user_writes.flush()  # count users who only exist in the write buffer so far
             total = await users_collection.count_documents({})
             prem = await users_collection.count_documents({'is_premium': True})
             await cb.answer(f"📊 Total Users: {total}\n💎 Premium Users: {prem}", show_alert=True)
@@ -462,9 +1607,53 @@ async def menu_callbacks(client, cb: CallbackQuery):
             await cb.message.edit_text("➖ **Remove Premium User**\n\nSend the **User ID** to revoke Premium access.\n\nType `/cancel` to stop.")
             user_conversations[uid] = {"state": "admin_rem_prem_wait", "is_manual": False}
 
+# --- OWNER PROFILER ---
+@bot.on_message(filters.command("profile") & filters.private)
+async def profile_cmd(client, message: Message):
+    global active_profile
+    if message.from_user.id != OWNER_ID:
+        return await message.reply_text("❌ You are not the Admin!")
+
+    args = [a.lower() for a in message.command[1:]]
+    if not args or args[0] == "help":
+        return await message.reply_text(
+            "🩺 **Profiler**\n\n"
+            "🔹 `/profile 50` - profile the next 50 handler calls\n"
+            "🔹 `/profile 30s` - profile the next 30 seconds\n"
+            "🔹 add `sample` for a collapsed-stack flamegraph instead of cProfile stats\n"
+            "🔹 `/profile stats` - wall/CPU time per handler & conversation state\n"
+            "🔹 `/profile reset` - clear the timing stats\n"
+            "🔹 `/profile stop` - finish the running profile now"
+        )
+    if args[0] == "stats":
+        queued, active_users = user_dispatcher.backlog()
+        return await message.reply_text(f"⏱️ **Handler Timings**\n```\n{format_handler_stats()}\n```\n🚦 Queued updates: `{queued}` across `{active_users}` users")
+    if args[0] == "reset":
+        handler_stats.clear()
+        return await message.reply_text("✅ Handler timing stats cleared.")
+    if args[0] == "stop":
+        if not active_profile: return await message.reply_text("🚫 No profile is running.")
+        active_profile.stop()
+        return await message.reply_text("✅ Profile stopped. Sending the report...")
+    if active_profile:
+        return await message.reply_text("⚠️ A profile is already running. Use `/profile stop` first.")
+
+    amount = args[0]
+    mode = "sample" if "sample" in args[1:] else "cprofile"
+    if re.fullmatch(r'\d+s', amount): calls, seconds = None, float(amount[:-1])
+    elif amount.isdigit(): calls, seconds = int(amount), None
+    else: return await message.reply_text("⚠️ **Usage:** `/profile 50` or `/profile 30s` (add `sample` for a flamegraph)")
+
+    active_profile = ProfileSession(client, message.chat.id, mode, calls=calls, seconds=seconds)
+    active_profile.start()
+    what = f"the next {calls} handler calls" if calls else f"{amount[:-1]} seconds"
+    await message.reply_text(f"🩺 **Profiling {what}** ({'stack sampling' if mode == 'sample' else 'cProfile'}). The report will be sent here.")
+
 # ---- PREMIUM LOCKED COMMANDS ----
 
 @bot.on_message(filters.command("badge") & filters.private)
+@serialize_per_user
+@track_handler("set_badge_text")
 @force_subscribe
 @check_premium
 async def set_badge_text(client, message: Message):
@@ -482,7 +1671,9 @@ async def set_badge_text(client, message: Message):
         else:
             await message.reply_text("⚠️ **Usage:** `/badge Your Text Here`\nTo remove a badge, use `/badge` without any text.")
 
-@bot.on_message(filters.command(["setwatermark", "cancel", "setapi", "setdomain", "settutorial", "settings"]) & filters.private)
+@bot.on_message(filters.command(["setwatermark", "cancel", "setapi", "setdomain", "settutorial", "setalbum", "settings"]) & filters.private)
+@serialize_per_user
+@track_handler("settings_commands")
 @force_subscribe
 @check_premium
 async def settings_commands(client, message: Message):
@@ -492,37 +1683,44 @@ async def settings_commands(client, message: Message):
 
     if command == "setwatermark":
         text = " ".join(message.command[1:]) if len(message.command) > 1 else None
-        await users_collection.update_one({'_id': uid}, {'$set': {'watermark_text': text}}, upsert=True)
+        await user_writes.update(uid, set={'watermark_text': text})
         await message.reply_text(f"✅ Watermark has been {'set to: `' + text + '`' if text else 'removed.'}")
             
     elif command == "cancel":
-        if uid in user_conversations: del user_conversations[uid]; await message.reply_text("✅ Process cancelled.")
+        if uid in user_conversations: clear_conversation(uid); await message.reply_text("✅ Process cancelled.")
         else: await message.reply_text("🚫 No active process to cancel.")
 
     elif command == "setapi":
         if len(message.command) > 1:
             api_key = message.command[1]
-            await users_collection.update_one({'_id': uid}, {'$set': {'shortener_api': api_key}}, upsert=True)
+            await user_writes.update(uid, set={'shortener_api': api_key})
             await message.reply_text(f"✅ Shortener API Key has been set: `{api_key}`")
         else: await message.reply_text("⚠️ Incorrect format!\n**Usage:** `/setapi <YOUR_API_KEY>`")
 
     elif command == "setdomain":
         if len(message.command) > 1:
             domain = message.command[1]
-            await users_collection.update_one({'_id': uid}, {'$set': {'shortener_url': domain}}, upsert=True)
+            await user_writes.update(uid, set={'shortener_url': domain})
             await message.reply_text(f"✅ Shortener domain has been set: `{domain}`")
         else: await message.reply_text("⚠️ Incorrect format!\n**Usage:** `/setdomain yourshortener.com`")
 
     elif command == "settutorial":
         if len(message.command) > 1:
             link = message.command[1]
-            await users_collection.update_one({'_id': uid}, {'$set': {'tutorial_link': link}}, upsert=True)
+            await user_writes.update(uid, set={'tutorial_link': link})
             await message.reply_text(f"✅ Tutorial link has been set: {link}")
         else:
-            await users_collection.update_one({'_id': uid}, {'$unset': {'tutorial_link': ""}}); await message.reply_text("✅ Tutorial link removed.")
+            await user_writes.update(uid, unset=['tutorial_link']); await message.reply_text("✅ Tutorial link removed.")
+
+    elif command == "setalbum":
+        if len(message.command) > 1 and message.command[1].isdigit():
+            count = min(int(message.command[1]), MAX_ALBUM_BACKDROPS)
+            await user_writes.update(uid, set={'album_backdrops': count})
+            await message.reply_text(f"✅ Album mode {'enabled with ' + str(count) + ' backdrops.' if count else 'disabled.'}")
+        else: await message.reply_text(f"⚠️ Incorrect format!\n**Usage:** `/setalbum <0-{MAX_ALBUM_BACKDROPS}>` (0 turns album mode off)")
 
     elif command == "settings":
-        user_data = await users_collection.find_one({'_id': uid})
+        user_data = await get_user_data(uid)
         if not user_data: return await message.reply_text("You haven't saved any settings yet.")
         
         channels = user_data.get('channel_ids', [])
@@ -532,6 +1730,7 @@ async def settings_commands(client, message: Message):
         settings_text += f"**Saved Channels:**\n{channel_text}\n\n"
         settings_text += f"**Watermark:** `{user_data.get('watermark_text', 'Not Set')}`\n"
         settings_text += f"**Tutorial Link:** `{user_data.get('tutorial_link', 'Not Set')}`\n"
+        settings_text += f"**Album Backdrops:** `{user_data.get('album_backdrops') or 'Off'}`\n"
         
         shortener_api = user_data.get('shortener_api')
         shortener_url = user_data.get('shortener_url')
@@ -542,6 +1741,8 @@ async def settings_commands(client, message: Message):
         await message.reply_text(settings_text)
 
 @bot.on_message(filters.command(["addchannel", "delchannel", "mychannels"]) & filters.private)
+@serialize_per_user
+@track_handler("channel_management")
 @force_subscribe
 @check_premium
 async def channel_management(client, message: Message):
@@ -563,41 +1764,71 @@ async def channel_management(client, message: Message):
         else: await message.reply_text("⚠️ Invalid Channel ID.\n**Usage:** `/delchannel -100...`")
 
     elif command == "mychannels":
-        user_data = await users_collection.find_one({'_id': uid})
+        user_data = await get_user_data(uid)
         channels = user_data.get('channel_ids', [])
         if not channels:
             return await message.reply_text("You have no saved channels. Use `/addchannel` to add one.")
         channel_text = "📋 **Your Saved Channels:**\n\n" + "\n".join([f"🔹 `{ch}`" for ch in channels])
         await message.reply_text(channel_text)
 
+@bot.on_message(filters.command(["scheduled", "unschedule"]) & filters.private)
+@serialize_per_user
+@track_handler("schedule_management")
+@force_subscribe
+@check_premium
+async def schedule_management(client, message: Message):
+    command = message.command[0].lower()
+    uid = message.from_user.id
+
+    if command == "scheduled":
+        jobs = await scheduled_collection.find({'user_id': uid, 'status': {'$in': ['pending', 'sending']}}).sort('due_at', 1).to_list(50)
+        if not jobs: return await message.reply_text("📭 You have no scheduled posts.")
+        lines = []
+        for job in jobs:
+            due_local = job['due_at'].replace(tzinfo=timezone.utc).astimezone(SCHEDULE_TZ)
+            lines.append(f"🔹 `{job['_id']}`\n    📢 `{job['chat_id']}` at `{due_local:%Y-%m-%d %H:%M}`")
+        await message.reply_text("⏰ **Your Scheduled Posts:**\n\n" + "\n".join(lines) + "\n\nUse `/unschedule <ID>` to cancel one.")
+
+    elif command == "unschedule":
+        if len(message.command) < 2: return await message.reply_text("⚠️ **Usage:** `/unschedule <ID>`")
+        try: job_id = ObjectId(message.command[1])
+        except Exception: return await message.reply_text("❌ Invalid ID.")
+        result = await scheduled_collection.delete_one({'_id': job_id, 'user_id': uid, 'status': 'pending'})
+        await message.reply_text("✅ Scheduled post cancelled." if result.deleted_count else "🚫 No pending post with that ID.")
+
 async def generate_final_post_preview(client, uid, cid, msg):
     convo = user_conversations.get(uid)
     if not convo: return
     
-    user_data = await users_collection.find_one({'_id': uid})
+    user_data = await get_user_data(uid)
     caption = await generate_channel_caption(convo["details"], convo["language"], convo["links"], user_data)
     watermark = user_data.get('watermark_text')
     badge = convo.pop('temp_badge_text', None) 
     
-    poster_input = None
-    if convo['details'].get('poster_bytes'):
-        poster_input = convo['details']['poster_bytes']
-        poster_input.seek(0)
-    elif convo['details'].get('poster_path'):
-        poster_input = f"https://image.tmdb.org/t/p/w500{convo['details']['poster_path']}"
-    
-    await msg.edit_text("🖼️ Creating smart poster...")
-    poster, error = watermark_poster(poster_input, watermark, badge_text=badge)
+    # --- Album Mode (poster + backdrops in one media group) ---
+    poster_buffer, album, error = None, [], None
+    backdrop_count = user_data.get('album_backdrops') or 0
+    if backdrop_count and not convo.get('is_manual') and convo['details'].get('poster_path'):
+        await msg.edit_text("🖼️ Creating album...")
+        poster_buffer, backdrops = await build_album(convo['details'], watermark, badge, backdrop_count)
+        if backdrops: album = [poster_buffer, *backdrops]  # no backdrops: the poster alone is the post
+
+    if not poster_buffer:
+        poster_input = None
+        if convo['details'].get('poster_file'):
+            poster_input = convo['details']['poster_file']
+        elif convo['details'].get('poster_path'):
+            await msg.edit_text("📥 Fetching poster...")
+            poster_input = await get_poster_file(convo['details']['poster_path'])
+
+        await msg.edit_text("🖼️ Creating smart poster...")
+        poster_buffer, error = await render_poster(poster_input, watermark, badge_text=badge)
     
     await msg.delete()
     if error: await client.send_message(cid, f"⚠️ **Error creating poster:** `{error}`")
 
-    poster_buffer = None
-    if poster:
-        poster_buffer = io.BytesIO(poster.read())
-        poster_buffer.name = "final_poster.png"
-
-    user_conversations[uid]['final_post'] = {'caption': caption, 'poster': poster_buffer}
+    final_post = {'caption': caption, 'poster': poster_buffer, 'album': album}
+    user_conversations[uid]['final_post'] = final_post
 
     saved_channels = user_data.get('channel_ids', [])
     if saved_channels:
@@ -606,27 +1837,24 @@ async def generate_final_post_preview(client, uid, cid, msg):
             try:
                 chat = await client.get_chat(int(channel_id))
                 channel_name = chat.title
-                buttons.append([InlineKeyboardButton(f"📢 Post to {channel_name}", callback_data=f"postto_{channel_id}")])
             except Exception:
-                buttons.append([InlineKeyboardButton(f"📢 Post to {channel_id}", callback_data=f"postto_{channel_id}")])
+                channel_name = channel_id
+            buttons.append([InlineKeyboardButton(f"📢 Post to {channel_name}", callback_data=f"postto_{channel_id}"),
+                            InlineKeyboardButton("⏰ Schedule", callback_data=f"schedule_{channel_id}")])
         
-        if poster_buffer:
-            poster_buffer.seek(0)
-            preview_msg = await client.send_photo(cid, photo=poster_buffer, caption=caption, parse_mode=enums.ParseMode.MARKDOWN)
-        else:
-            preview_msg = await client.send_message(cid, caption, parse_mode=enums.ParseMode.MARKDOWN)
+        preview_msgs = await send_final_post(client, cid, final_post)
+        preview_msg = preview_msgs[0]
+        final_post['file_ids'] = [m.photo.file_id for m in preview_msgs if m.photo]
 
         if buttons:
             await client.send_message(cid, "**👆 This is a preview. Choose a channel to post to:**", reply_to_message_id=preview_msg.id, reply_markup=InlineKeyboardMarkup(buttons))
     else:
-        if poster_buffer:
-            poster_buffer.seek(0)
-            await client.send_photo(cid, photo=poster_buffer, caption=caption, parse_mode=enums.ParseMode.MARKDOWN)
-        else:
-            await client.send_message(cid, caption, parse_mode=enums.ParseMode.MARKDOWN)
+        await send_final_post(client, cid, final_post)
         await client.send_message(cid, "✅ Preview generated. You have no channels saved. Use `/addchannel` to add one.")
 
 @bot.on_message(filters.command("post") & filters.private)
+@serialize_per_user
+@track_handler("search_commands")
 @force_subscribe
 @check_premium
 async def search_commands(client, message: Message):
@@ -645,7 +1873,7 @@ async def search_commands(client, message: Message):
             media_type = tmdb_link_match.group(1) # movie or tv
             tmdb_id = tmdb_link_match.group(2)    # ID
             await processing_msg.edit_text(f"🔗 TMDB Link detected (ID: {tmdb_id}). Fetching...")
-            details = get_tmdb_details(media_type, int(tmdb_id))
+            details = await get_tmdb_details(media_type, int(tmdb_id))
             if details:
                 details['media_type'] = media_type 
                 results = [details]
@@ -653,9 +1881,9 @@ async def search_commands(client, message: Message):
         elif imdb_match:
             imdb_id = imdb_match.group(1)
             await processing_msg.edit_text(f"🔗 IMDb ID `{imdb_id}` detected. Fetching...")
-            results = search_tmdb_by_imdb(imdb_id)
+            results = await search_tmdb_by_imdb(imdb_id)
         else:
-            results = search_tmdb(query)
+            results = await search_tmdb(query)
 
     except Exception as e:
         logger.error(f"Search processing error: {e}")
@@ -682,6 +1910,8 @@ async def search_commands(client, message: Message):
 
 # Handler for Manual Flow & Select
 @bot.on_callback_query(filters.regex("^manual_"))
+@serialize_per_user
+@track_handler("manual_handler")
 async def manual_handler(client, cb: CallbackQuery):
     data = cb.data
     uid = cb.from_user.id
@@ -694,6 +1924,7 @@ async def manual_handler(client, cb: CallbackQuery):
     
     elif data.startswith("manual_type_"):
         m_type = data.split("_")[2] # movie or tv
+        clear_conversation(uid)
         user_conversations[uid] = {
             "details": {"media_type": m_type},
             "links": {},
@@ -703,16 +1934,19 @@ async def manual_handler(client, cb: CallbackQuery):
         await cb.message.edit_text(f"📝 **Manual {m_type.capitalize()} Mode**\n\nPlease send the **Title** of the content:")
 
 @bot.on_callback_query(filters.regex("^select_"))
+@serialize_per_user
+@track_handler("selection_cb")
 async def selection_cb(client, cb: CallbackQuery):
     await cb.answer("Fetching details...", show_alert=False)
     try: _, flow, media_type, mid = cb.data.split("_", 3)
     except: return await cb.message.edit_text("Invalid callback data.")
         
-    details = get_tmdb_details(media_type, int(mid))
+    details = await get_tmdb_details(media_type, int(mid))
     if not details: return await cb.message.edit_text("❌ Sorry, couldn't fetch details from TMDB.")
     
     if 'media_type' not in details: details['media_type'] = media_type
     uid = cb.from_user.id
+    clear_conversation(uid)
     user_conversations[uid] = {"details": details, "links": {}, "state": ""}
     
     if media_type == "tv":
@@ -723,7 +1957,22 @@ async def selection_cb(client, cb: CallbackQuery):
         await cb.message.edit_text("**Movie Post:** Enter the language for the movie.")
 
 # ---- 5. UNIFIED CONVERSATION HANDLER (Admin Inputs + Post Inputs) ----
+async def run_broadcast(message: Message, msg: Message):
+    await user_writes.flush()
+    users = users_collection.find({})
+    sent, failed = 0, 0
+    async for user in users:
+        try:
+            await message.copy(chat_id=user['_id'])
+            sent += 1
+            await asyncio.sleep(0.1)
+        except Exception: failed += 1
+    await msg.edit_text(f"✅ **Broadcast Complete!**\n\nSent: {sent}\nFailed: {failed}")
+    return {'sent': sent, 'failed': failed}
+
 @bot.on_message(filters.private & (filters.text | filters.photo))
+@serialize_per_user
+@track_handler("conversation_handler", state_of=lambda m: (user_conversations.get(m.from_user.id) or {}).get('state'))
 @force_subscribe
 async def conversation_handler(client, message: Message):
     uid = message.from_user.id
@@ -737,16 +1986,9 @@ async def conversation_handler(client, message: Message):
     if state == "admin_broadcast_wait":
         if uid != OWNER_ID: return
         msg = await message.reply_text("📣 Sending Broadcast... Please wait.")
-        users = users_collection.find({})
-        sent, failed = 0, 0
-        async for user in users:
-            try:
-                await message.copy(chat_id=user['_id'])
-                sent += 1
-                await asyncio.sleep(0.1)
-            except: failed += 1
-        await msg.edit_text(f"✅ **Broadcast Complete!**\n\nSent: {sent}\nFailed: {failed}")
-        del user_conversations[uid]
+        clear_conversation(uid)
+        # Runs for minutes on a big user base; keep it off the owner's update queue
+        spawn_background(run_broadcast(message, msg), "broadcast")
         return
 
     elif state == "admin_add_prem_wait":
@@ -756,7 +1998,7 @@ async def conversation_handler(client, message: Message):
             await users_collection.update_one({'_id': target_id}, {'$set': {'is_premium': True}}, upsert=True)
             await message.reply_text(f"✅ User `{target_id}` is now **Premium**.")
         except: await message.reply_text("❌ Invalid ID.")
-        del user_conversations[uid]
+        clear_conversation(uid)
         return
 
     elif state == "admin_rem_prem_wait":
@@ -766,7 +2008,7 @@ async def conversation_handler(client, message: Message):
             await users_collection.update_one({'_id': target_id}, {'$set': {'is_premium': False}})
             await message.reply_text(f"✅ User `{target_id}` is now **Free**.")
         except: await message.reply_text("❌ Invalid ID.")
-        del user_conversations[uid]
+        clear_conversation(uid)
         return
 
     # --- REGULAR USER POST STATES ---
@@ -803,8 +2045,8 @@ async def conversation_handler(client, message: Message):
     elif state == "wait_manual_poster":
         if not message.photo: return await message.reply_text("⚠️ Please send an image (Photo).")
         msg = await message.reply_text("📥 Downloading poster...")
-        photo = await client.download_media(message, in_memory=True)
-        convo["details"]["poster_bytes"] = photo
+        # Straight to a spool file: no in-memory copy is kept around for the rest of the session
+        convo["details"]["poster_file"] = await client.download_media(message, file_name=spool_path(".jpg"))
         
         if convo["details"]["media_type"] == "tv":
             convo["state"] = "wait_tv_lang"
@@ -871,7 +2113,42 @@ async def conversation_handler(client, message: Message):
         convo['state'] = 'wait_season_number'
         await message.reply_text(f"✅ Season {s_num} saved.\n\n**👉 Enter next Season Number, or type `done` to finish.**")
 
+    elif state == "wait_schedule_time":
+        due_at = parse_schedule_time(text)
+        if not due_at: return await message.reply_text("❌ Couldn't read that time. Try `+2h` or `2025-01-31 21:30`.")
+        if due_at <= utcnow(): return await message.reply_text("❌ That time is already in the past.")
+        job_id = await schedule_post(uid, convo['schedule_channel'], convo['final_post'], due_at)
+        due_local = due_at.replace(tzinfo=timezone.utc).astimezone(SCHEDULE_TZ)
+        await message.reply_text(f"✅ **Scheduled!** Posting to `{convo['schedule_channel']}` at `{due_local:%Y-%m-%d %H:%M}`.\nID: `{job_id}`")
+        clear_conversation(uid)
+
+@bot.on_callback_query(filters.regex("^schedule_"))
+@serialize_per_user
+@track_handler("schedule_cb")
+async def schedule_cb(client, cb: CallbackQuery):
+    uid = cb.from_user.id
+    channel_id = cb.data.split("_")[1]
+
+    convo = user_conversations.get(uid)
+    if not convo or 'final_post' not in convo:
+        await cb.answer("❌ Session expired!", show_alert=True)
+        return
+
+    await cb.answer()
+    convo['state'] = 'wait_schedule_time'
+    convo['schedule_channel'] = channel_id
+    await cb.message.edit_text(
+        f"⏰ **Schedule post to** `{channel_id}`\n\n"
+        "Send the time to post at:\n"
+        "🔹 `+30m`, `+2h`, `+1d` - from now\n"
+        "🔹 `21:30` - next time the clock shows it\n"
+        "🔹 `2025-01-31 21:30` - exact date & time\n\n"
+        "Type `/cancel` to stop."
+    )
+
 @bot.on_callback_query(filters.regex("^postto_"))
+@serialize_per_user
+@track_handler("post_to_channel_cb")
 async def post_to_channel_cb(client, cb: CallbackQuery):
     uid = cb.from_user.id
     channel_id = cb.data.split("_")[1]
@@ -885,18 +2162,36 @@ async def post_to_channel_cb(client, cb: CallbackQuery):
     final_post = convo['final_post']
     
     try:
-        if final_post['poster']:
-            final_post['poster'].seek(0)
-            await client.send_photo(int(channel_id), final_post['poster'], caption=final_post['caption'], parse_mode=enums.ParseMode.MARKDOWN)
-        else:
-            await client.send_message(int(channel_id), final_post['caption'], parse_mode=enums.ParseMode.MARKDOWN)
+        await send_final_post(client, int(channel_id), final_post)
         await cb.message.edit_text(f"✅ **Posted to channel successfully!**")
     except Exception as e:
         await cb.message.edit_text(f"❌ **Failed to post.**\nError: `{e}`")
     finally:
-        if uid in user_conversations: del user_conversations[uid]
+        clear_conversation(uid)
 
 # ---- 6. START THE BOT ----
+async def main():
+    await bot.start()
+    await scheduled_collection.create_index([('status', 1), ('due_at', 1)])
+    background_tasks = [
+        asyncio.create_task(scheduled_post_dispatcher(bot)),
+        asyncio.create_task(spool_janitor()),
+        asyncio.create_task(trending_prefetcher()),
+    ]
+    flusher = asyncio.create_task(user_writes.flusher())
+    logger.info("✅ Bot started. Scheduled post dispatcher running.")
+    await idle()
+    # Handlers still queued or running may write users; finish them before the final flush
+    await user_dispatcher.shutdown(SHUTDOWN_GRACE)
+    for task in background_tasks: task.cancel()
+    for task in list(background_jobs): task.cancel()
+    await asyncio.gather(*background_tasks, *background_jobs, return_exceptions=True)
+    # Don't lose buffered user writes on shutdown: let the flusher finish its last write instead of cancelling it
+    user_writes.stop()
+    await flusher
+    await user_writes.flush()
+    await bot.stop()
+
 if __name__ == "__main__":
     logger.info("🚀 Bot is starting with Premium System...")
-    bot.run()
+    bot.run(main())